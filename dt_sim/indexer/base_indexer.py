@@ -2,10 +2,12 @@ from pathlib import Path
 from typing import List, Tuple, Union
 
 import numpy as np
+import faiss
 
 from dt_sim.indexer.faiss_cache import faiss_cache
+from dt_sim.indexer.shard_manifest import ShardManifest
 
-__all__ = ['BaseIndexer',
+__all__ = ['BaseIndexer', 'read_shard',
            'DiffScores', 'VectorIDs', 'FaissSearch']
 
 
@@ -14,6 +16,27 @@ VectorIDs = List[List[np.int64]]
 FaissSearch = Tuple[DiffScores, VectorIDs]
 
 
+def read_shard(shard_path: Union[str, Path], nprobe: int = None) -> faiss.Index:
+    """
+    Opens a deployed shard without write access.
+        On-disk inverted lists (.ivfdata) are memory-mapped read-only, so
+        every process that serves the same shard shares one copy of it
+        through the page cache.
+
+    :param shard_path: /full/path/to/shard.index
+    :param nprobe: Number of centroids to visit during search (optional)
+    """
+    read_only = getattr(faiss, 'IO_FLAG_READ_ONLY', 0)
+    try:
+        shard = faiss.read_index(str(shard_path), read_only)
+    except RuntimeError:
+        shard = faiss.read_index(str(shard_path),
+                                 faiss.IO_FLAG_ONDISK_SAME_DIR | read_only)
+    if nprobe is not None:
+        shard.nprobe = nprobe
+    return shard
+
+
 class BaseIndexer(object):
     def __init__(self):
         self.index = None
@@ -26,10 +49,39 @@ class BaseIndexer(object):
     @staticmethod
     def get_index_paths(index_dir_path: Union[str, Path], recursive: bool = False
                         ) -> List[Path]:
-        pattern = '*/*.index' if recursive else '*.index'
-        index_paths = list(Path(index_dir_path).glob(pattern))
+        """
+        Globs each directory for *.index shards (every shard is listed,
+        whether or not its directory's ShardManifest has recorded it).
+        :param recursive: Look in sub directories of index_dir_path (only)
+        """
+        if recursive:
+            index_dirs = [d for d in Path(index_dir_path).iterdir() if d.is_dir()]
+        else:
+            index_dirs = [Path(index_dir_path)]
+
+        index_paths = list()
+        for index_dir in index_dirs:
+            index_paths += list(index_dir.glob('*.index'))
         return sorted(index_paths)
 
+    @staticmethod
+    def shares_base_index(index_paths: List[Union[str, Path]]) -> bool:
+        """
+        Checks the base-index fingerprints recorded in ShardManifests
+        (shards without a manifest entry are assumed to match).
+        :return: False if the shards were built from different base indexes
+        """
+        manifests = dict()
+        fingerprints = set()
+        for index_path in index_paths:
+            index_dir = Path(index_path).parent
+            if index_dir not in manifests:
+                manifests[index_dir] = ShardManifest(index_dir)
+            entry = manifests[index_dir].get(index_path)
+            if entry is not None:
+                fingerprints.add(entry['base_fingerprint'])
+        return len(fingerprints) <= 1
+
     @staticmethod
     def joint_sort(scores: DiffScores, ids: VectorIDs) -> FaissSearch:
         """
@@ -51,3 +103,77 @@ class BaseIndexer(object):
         sorted_scores, sorted_ids = (list(sorted_scs_ids) for sorted_scs_ids
                                      in zip(*sorted(zip(scores, ids))))
         return [sorted_scores], [sorted_ids]
+
+    @staticmethod
+    def merge_top_k(shard_hits: List[Tuple[np.array, np.array]], k: int
+                    ) -> Tuple[np.array, np.array]:
+        """
+        Merges sorted per-shard hits into the global top-k (ascending scores).
+            Shards are visited in order of their best score. Once no
+            remaining shard can beat the current k-th score, merging stops.
+        :param shard_hits: (scores, ids) arrays from each shard, each sorted
+            in ascending order
+        :param k: Number of hits to keep
+        :return: Top-k scores in ascending order with corresponding ids
+        """
+        shard_hits = [(dd[:k], ii[:k]) for dd, ii in shard_hits if len(dd)]
+        if not shard_hits or k < 1:
+            return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+        shard_hits.sort(key=lambda dd_ii: dd_ii[0][0])
+
+        # Upper bound on the final k-th score (from the best-headed shards)
+        bound, n_seen = np.inf, 0
+        for j, (dd, _) in enumerate(shard_hits):
+            n_seen += len(dd)
+            if n_seen >= k:
+                heads = np.concatenate([d for d, _ in shard_hits[:j + 1]])
+                bound = np.partition(heads, k - 1)[k - 1]
+                break
+
+        # Only hits within the bound can make the top-k
+        D, I = list(), list()
+        for dd, ii in shard_hits:
+            if dd[0] > bound:
+                break
+            n_keep = np.searchsorted(dd, bound, side='right')
+            D.append(dd[:n_keep]), I.append(ii[:n_keep])
+        D, I = np.concatenate(D), np.concatenate(I)
+
+        if len(D) > k:
+            top_k = np.argpartition(D, k - 1)[:k]
+            D, I = D[top_k], I[top_k]
+        order = np.argsort(D, kind='stable')
+        return D[order], I[order]
+
+    @staticmethod
+    def top_k_docs(scores: np.array, ids: np.array, k: int
+                   ) -> Tuple[np.array, np.array, int]:
+        """
+        Groups hits by document (doc_id = faiss_id // 10000) and keeps every
+            hit of the k docs with the best (lowest) scoring sentence.
+        :param scores: Hit L2 distances (any order)
+        :param ids: Corresponding faiss vector ids
+        :param k: Number of docs to keep
+        :return: Hits of the top-k docs (docs ordered by their best score,
+            each doc's hits in ascending order), number of docs kept
+        """
+        scores, ids = np.asarray(scores), np.asarray(ids)
+        valid = ids >= 0
+        if not valid.all():
+            scores, ids = scores[valid], ids[valid]
+        if not len(ids) or k < 1:
+            return scores[:0], ids[:0], 0
+
+        # Group hits by doc (hits sorted by score within each doc)
+        doc_ids = ids // 10000
+        order = np.lexsort((ids, scores, doc_ids))
+        scores, ids, doc_ids = scores[order], ids[order], doc_ids[order]
+        starts = np.flatnonzero(np.r_[True, doc_ids[1:] != doc_ids[:-1]])
+        sizes = np.diff(np.r_[starts, len(doc_ids)])
+
+        # Rank docs by their best hit, then gather the top-k docs' hits
+        top_docs = np.argsort(scores[starts], kind='stable')[:k]
+        sizes = sizes[top_docs]
+        keep = np.repeat(starts[top_docs] - np.cumsum(sizes) + sizes, sizes) \
+            + np.arange(sizes.sum())
+        return scores[keep], ids[keep], len(top_docs)
@@ -1,45 +1,192 @@
+import sys
+from time import monotonic
+from hashlib import sha1
 from collections import OrderedDict
 from threading import RLock
 from pickle import dumps
 
-__all__ = ["faiss_cache"]
+import numpy as np
 
+__all__ = ["faiss_cache", "LRUCache", "array_key", "make_key", "estimate_nbytes"]
 
-def faiss_cache(cacheable_func, limit: int = None):
+kwargs_mark = object()  # Separates positional from keyword args in keys
+
+
+def faiss_cache(cacheable_func=None, limit: int = None,
+                max_bytes: int = None, ttl: float = None):
     """
     Decorator: Caches a function's return value each time it is called.
         If called later with the same arguments, the cached value
         is returned (not reevaluated).
 
         Works with Faiss index.search()
-        Holds maxsize results. Drops the Least Recently Used result.
+        Holds limit results and at most max_bytes of results.
+        Drops the Least Recently Used result.
+        Results older than ttl seconds are reevaluated.
 
-    Note: Only pass positional args to wrapper (do NOT @faiss_cache(limit=int))
+    Usage:
+        @faiss_cache(128)
+        @faiss_cache(limit=128, max_bytes=2**28, ttl=600)
+
+    Note: Numpy arguments are keyed by a digest of their data (see make_key).
+        Misses are evaluated without holding the cache lock, so a slow
+        search never blocks concurrent hits.
+        Read counters at runtime with my_func.cache_info()
     """
-    if isinstance(cacheable_func, int):
+    if cacheable_func is None or isinstance(cacheable_func, int):
+        if isinstance(cacheable_func, int):
+            limit = cacheable_func
+
         def faiss_cache_wrapper(f):
-            return faiss_cache(f, cacheable_func)
+            return faiss_cache(f, limit=limit, max_bytes=max_bytes, ttl=ttl)
 
         return faiss_cache_wrapper
 
-    cache_q = OrderedDict()
-    lock = RLock()
+    cache = LRUCache(limit=limit, max_bytes=max_bytes, ttl=ttl)
+    missing = object()
 
     def faiss_cache_wrapper(*args, **kwargs):
-        key = dumps((args[1:], kwargs))  # Skip Faiss index.self arg
-        with lock:
-            try:
-                cache_q.move_to_end(key)
-            except KeyError:
-                cache_q[key] = cacheable_func(*args, **kwargs)
-                if limit and len(cache_q) > limit:
-                    cache_q.popitem(last=False)
+        key = make_key(args[1:], kwargs)  # Skip Faiss index.self arg
+        result = cache.get(key, missing)
+        if result is missing:
+            result = cacheable_func(*args, **kwargs)
+            cache.put(key, result)
+        return result
 
-        return cache_q[key]
-
-    faiss_cache_wrapper._cache_q = cache_q
+    faiss_cache_wrapper._cache = cache
     faiss_cache_wrapper._limit = limit
     faiss_cache_wrapper._function = cacheable_func
+    faiss_cache_wrapper.cache_info = cache.stats
+    faiss_cache_wrapper.cache_clear = cache.clear
     faiss_cache_wrapper.__name__ = cacheable_func.__name__
+    faiss_cache_wrapper.__doc__ = cacheable_func.__doc__
 
     return faiss_cache_wrapper
+
+
+class LRUCache(object):
+    """
+    Thread-safe mapping that holds at most limit values and max_bytes
+        of (estimated) value memory. Drops the Least Recently Used value.
+        Values older than ttl seconds are treated as misses.
+    """
+
+    def __init__(self, limit: int = None, max_bytes: int = None, ttl: float = None):
+        self.limit = limit
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._cache_q = OrderedDict()   # key: (value, nbytes, expires_at)
+        self._lock = RLock()
+
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, n_bytes, expires_at = self._cache_q[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires_at is not None and expires_at < monotonic():
+                del self._cache_q[key]
+                self.n_bytes -= n_bytes
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._cache_q.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        n_bytes = estimate_nbytes(value) if self.max_bytes else 0
+        if self.max_bytes and n_bytes > self.max_bytes:
+            return  # Would evict everything else
+        expires_at = monotonic() + self.ttl if self.ttl else None
+
+        with self._lock:
+            if key in self._cache_q:
+                self.n_bytes -= self._cache_q[key][1]
+            self._cache_q[key] = (value, n_bytes, expires_at)
+            self._cache_q.move_to_end(key)
+            self.n_bytes += n_bytes
+
+            while self._cache_q and (
+                    (self.limit and len(self._cache_q) > self.limit) or
+                    (self.max_bytes and self.n_bytes > self.max_bytes)):
+                _, (_, old_bytes, _) = self._cache_q.popitem(last=False)
+                self.n_bytes -= old_bytes
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._cache_q.clear()
+            self.n_bytes = 0
+
+    def items(self) -> list:
+        """ Snapshot of unexpired (key, value) pairs (least recent first) """
+        now = monotonic()
+        with self._lock:
+            return [(key, value) for key, (value, _, expires_at) in self._cache_q.items()
+                    if expires_at is None or expires_at >= now]
+
+    def stats(self) -> dict:
+        with self._lock:
+            n_lookups = self.hits + self.misses
+            return {'entries': len(self._cache_q),
+                    'bytes': self.n_bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': self.hits / n_lookups if n_lookups else 0.0,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations,
+                    'limit': self.limit,
+                    'max_bytes': self.max_bytes,
+                    'ttl': self.ttl}
+
+    def __len__(self):
+        return len(self._cache_q)
+
+
+def array_key(array: np.array) -> bytes:
+    """ Cheap, hashable digest of a numpy array (dtype, shape and data) """
+    array = np.ascontiguousarray(array)
+    digest = sha1(array.tobytes())
+    digest.update(f'{array.dtype.str}{array.shape}'.encode())
+    return digest.digest()
+
+
+def make_key(args: tuple, kwargs: dict) -> tuple:
+    """
+    Builds a hashable cache key without pickling numpy arrays.
+        Unhashable, non-numpy arguments fall back to pickle.
+    """
+    def key_part(arg):
+        if isinstance(arg, np.ndarray):
+            return np.ndarray, array_key(arg)
+        try:
+            hash(arg)
+            return arg
+        except TypeError:
+            return type(arg), dumps(arg)
+
+    key = tuple(key_part(arg) for arg in args)
+    if kwargs:
+        key += (kwargs_mark,) + tuple((name, key_part(kwargs[name]))
+                                      for name in sorted(kwargs))
+    return key
+
+
+def estimate_nbytes(value) -> int:
+    """ Approximate memory held by a cached value (numpy-aware) """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sys.getsizeof(value) + sum(estimate_nbytes(v) for v in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_nbytes(k) + estimate_nbytes(v)
+                                          for k, v in value.items())
+    return sys.getsizeof(value)
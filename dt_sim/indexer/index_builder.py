@@ -10,6 +10,7 @@ import faiss
 
 from dt_sim.data_reader.npz_io_funcs import load_training_npz
 from dt_sim.indexer.base_indexer import BaseIndexer
+from dt_sim.indexer.shard_manifest import ShardManifest
 
 __all__ = ['OnDiskIVFBuilder']
 
@@ -103,6 +104,7 @@ class OnDiskIVFBuilder:
 
         # Delete intermediate files that were zipped into
         for tmp_idx in stale_files:
+            ShardManifest.for_index(tmp_idx).discard(tmp_idx)
             os.remove(str(tmp_idx))
             os.remove(str(tmp_idx).replace('.index', '.ivfdata'))
 
@@ -189,6 +191,7 @@ class OnDiskIVFBuilder:
                       f'To:     {new_index_path} ({n_vectors_mvd} vectors) \n')
             else:
                 os.remove(ivfdata_path), os.remove(index_path)
+                ShardManifest.for_index(index_path).discard(index_path)
                 print(f'Moved: {index_path} and its .ivfdata file \n'
                       f'To:    {new_index_path} ({n_vectors_mvd} vectors) \n')
             return n_vectors_mvd
@@ -211,6 +214,8 @@ class OnDiskIVFBuilder:
         :param ivfdata_path: Path to output.ivfdata file (on-disk searchable data)
         :param ivfindex_paths: Paths to indexes to be merged
         :return: Number of vectors indexed
+
+        Note: The new shard is recorded in its directory's ShardManifest.
         """
         # Collect IVF data from subindexes
         ivfs = list()
@@ -236,6 +241,7 @@ class OnDiskIVFBuilder:
         index.ntotal = ntotal
         index.replace_invlists(invlists)
         faiss.write_index(index, index_path)
+        ShardManifest.for_index(index_path).record(index_path, index)
         return int(ntotal)
 
     def generate_subindex(self, subindex_path: str,
@@ -325,6 +331,8 @@ class OnDiskIVFBuilder:
                          recursive: bool = False) -> int:
         """
         Easy way to check how many vectors are indexed (defaults to all in dir)
+            Reads ntotal from the ShardManifest (only unrecorded or stale
+            shards are opened)
 
         :param index_dir: /path/to/files.index
         :param start_date: Index ISO date to start counting from
@@ -335,13 +343,18 @@ class OnDiskIVFBuilder:
         n_vect = 0
         ISO_seed = str('\d{4}[-/]\d{2}[-/]\d{2}')
         for (p_dir, _, files) in os.walk(index_dir):
+            manifest = ShardManifest(p_dir)
             for f in files:
                 if f.endswith('.index'):
                     index_path = p.join(p_dir, f)
                     check_date = re.search(ISO_seed, index_path).group()
                     # Dates are inclusive
                     if start_date <= check_date <= end_date:
-                        n_vect += faiss.read_index(p.abspath(index_path)).ntotal
+                        entry = manifest.get(index_path)
+                        if entry is not None:
+                            n_vect += entry['ntotal']
+                        else:
+                            n_vect += faiss.read_index(p.abspath(index_path)).ntotal
             if not recursive:
                 break
 
@@ -1,20 +1,38 @@
-import re
-from time import sleep
+import os
+import atexit
+import traceback
 from pathlib import Path
-from typing import Union
-from multiprocessing import Pipe, Process, Queue
+from datetime import date, timedelta
+from itertools import count
+from collections import Counter
+from queue import Empty, Queue as ThreadQueue
+from time import sleep, time
+from typing import List, Tuple, Union
+from threading import Condition, Event, Lock, Thread
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import BoundedSemaphore, Pipe, Process, Queue
 
 import faiss
 import numpy as np
 
 from .base_indexer import *
-from .faiss_cache import faiss_cache
+from .faiss_cache import faiss_cache, LRUCache, array_key
+from .preassigned_search import *
+from .rw_lock import ReadWriteLock
+from .shm_ipc import SharedArrays, share_arrays, load_arrays
+from .shard_catalog import ShardCatalog, DateRange
+from .shard_manifest import ShardManifest, list_sizes
+from .warmup import warm_lists, prefetch_probed
+from .tiering import promote_to_ram, ram_resident, plan_hot_shards
+from .nprobe_tuner import NprobeTuner
 
 __all__ = ['DeployShards', 'RangeShards']
 
 
 class DeployShards(BaseIndexer):
-    def __init__(self, shard_dir, nprobe: int = 4):
+    def __init__(self, shard_dir, nprobe: int = 4,
+                 base_index_path: Union[str, Path] = None, preassign: bool = True,
+                 load_workers: int = 8):
         """
         For deploying multiple, pre-made IVF indexes as shards.
             (intended for on-disk indexes that do not fit in memory)
@@ -24,30 +42,73 @@ class DeployShards(BaseIndexer):
         :param shard_dir: Dir containing faiss index shards
         :param nprobe: Number of clusters to visit during search
                        (speed accuracy trade-off)
+        :param base_index_path: Pre-trained base index the shards were built
+            from (optional: the coarse quantizer is otherwise read from a shard)
+        :param preassign: Search the shared coarse quantizer once per query
+            and reuse its centroids for every shard
+        :param load_workers: Number of shards read concurrently at startup
         """
         super().__init__()
         self.paths_to_shards = self.get_index_paths(shard_dir)
         self.nprobe = nprobe
 
-        # Load shards
-        shards = list()
-        for shard_path in self.paths_to_shards:
-            shard = self.load_shard(path_to_shard=shard_path, nprobe=self.nprobe)
-            shards.append(shard)
+        # Load shards (bounded, concurrent reads)
+        with ThreadPoolExecutor(max_workers=max(1, load_workers)) as loader:
+            self.shards = list(loader.map(
+                lambda shard_path: self.load_shard(shard_path, nprobe=self.nprobe),
+                self.paths_to_shards))
 
         # Merge shards
         self.index = faiss.IndexShards(512, threaded=True, successive_ids=False)
-        for shard in shards:
+        for shard in self.shards:
             self.index.add_shard(shard)
 
+        # All shards share the coarse quantizer of their base index
+        if preassign and not self.shares_base_index(self.paths_to_shards):
+            print('WARNING: Shards were built from different base indexes \n'
+                  '         Coarse preassignment is disabled')
+            preassign = False
+        self.preassign = preassign
+        self.quantizer = None
+        if preassign and (base_index_path or self.paths_to_shards):
+            self.quantizer = load_quantizer(base_index_path or self.paths_to_shards[0])
+        self.pool = ThreadPoolExecutor(max_workers=max(1, len(self.shards)))
+
+    @faiss_cache(128)
+    def search(self, query_vector: np.array, k: int) -> FaissSearch:
+        if self.quantizer is None:
+            return self.index.search(query_vector, k)
+        return self.search_preassigned(query_vector, k)
+
+    def search_preassigned(self, query_vector: np.array, k: int) -> FaissSearch:
+        """
+        Searches every shard's inverted lists with centroids computed once.
+        :param query_vector: Query embedding(s) shaped (n_queries, dim)
+        :param k: Number of nearest neighbors per query
+        :return: Distances and ids shaped (n_queries, k)
+        """
+        query_vector = np.ascontiguousarray(query_vector, dtype=np.float32)
+        if len(query_vector.shape) < 2:
+            query_vector = np.reshape(query_vector, (1, query_vector.shape[0]))
+        coarse = coarse_assign(self.quantizer, query_vector, self.nprobe)
+
+        shard_results = list(self.pool.map(
+            lambda shard: search_preassigned(shard, query_vector, k, coarse),
+            self.shards
+        ))
+        if not shard_results:
+            n = query_vector.shape[0]
+            return np.full((n, k), np.inf, dtype=np.float32), -np.ones((n, k), dtype=np.int64)
+
+        # Keep the k best hits per query across shards
+        D = np.hstack([dd for dd, _ in shard_results])
+        I = np.hstack([ii for _, ii in shard_results])
+        top_k = np.argsort(D, axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(D, top_k, axis=1), np.take_along_axis(I, top_k, axis=1)
+
     @staticmethod
     def load_shard(path_to_shard: Union[str, Path], nprobe: int = 4):
-        try:
-            shard = faiss.read_index(path_to_shard)
-        except RuntimeError:
-            shard = faiss.read_index(path_to_shard, faiss.IO_FLAG_ONDISK_SAME_DIR)
-        shard.nprobe = nprobe
-        return shard
+        return read_shard(path_to_shard, nprobe)
 
     def add_shard(self, new_shard_path: Union[str, Path]):
         if new_shard_path in self.paths_to_shards:
@@ -56,123 +117,1040 @@ class DeployShards(BaseIndexer):
             return
         self.paths_to_shards.append(new_shard_path)
         shard = self.load_shard(path_to_shard=new_shard_path, nprobe=self.nprobe)
+        self.shards.append(shard)
         self.index.add_shard(shard)
 
+        # Resize the fan-out pool
+        self.pool.shutdown(wait=False)
+        self.pool = ThreadPoolExecutor(max_workers=len(self.shards))
+        if self.preassign and not self.shares_base_index(
+                list(self.paths_to_shards) + [new_shard_path]):
+            print('WARNING: New shard was built from a different base index \n'
+                  '         Coarse preassignment is disabled')
+            self.preassign, self.quantizer = False, None
+        if self.quantizer is None and self.preassign:
+            self.quantizer = load_quantizer(new_shard_path)
+        self.search.cache_clear()   # Cached results miss the new shard
+
+    def remove_shard(self, shard_path: Union[str, Path]) -> bool:
+        """ :return: True if the shard was deployed (and is now offline) """
+        paths = [str(path) for path in self.paths_to_shards]
+        if str(shard_path) not in paths:
+            return False
+        i = paths.index(str(shard_path))
+        self.paths_to_shards.pop(i)
+        self.shards.pop(i)
+
+        # Rebuild the merged index without the shard
+        self.index = faiss.IndexShards(512, threaded=True, successive_ids=False)
+        for shard in self.shards:
+            self.index.add_shard(shard)
+        self.pool.shutdown(wait=False)
+        self.pool = ThreadPoolExecutor(max_workers=max(1, len(self.shards)))
+        self.search.cache_clear()   # Cached results may hold the shard's hits
+        return True
+
 
 #### Parallelized Nearest Neighbor Search ####
 class Shard(Process):
     def __init__(self, shard_name, shard_path: Union[str, Path],
                  input_pipe: Pipe, output_queue: Queue,
-                 nprobe: int = 4, daemon: bool = False):
-        """ RangeShards search worker """
+                 nprobe: int = 4, daemon: bool = True, generation: int = 0,
+                 load_slots: BoundedSemaphore = None, prefetch: bool = True):
+        """
+        RangeShards search worker.
+            Long-running process that loads its index once, then answers
+            search requests from input_pipe until it receives None
+            (or its parent process exits).
+
+        Note: The index is read inside the worker process (see self.run()),
+            so the parent process never holds a copy of the shard.
+            Once read, the worker puts (None, 'loaded', name, generation,
+            loaded: bool, ntotal, non-empty list mask) on output_queue. A ('warmup', list_ids, max_bytes)
+            request pulls inverted lists into the page cache and is answered
+            with (None, 'warmed', name, n_bytes). A ('tier', hot: bool) request
+            copies the inverted lists into RAM (or re-reads them from disk) and
+            is answered with (None, 'tiered', name, hot, n_bytes in RAM).
+
+            Search requests are (ticket, queries, rows, k, radius, by_doc,
+            n_neighbors, nprobe, expires), answered with (ticket, name, hits).
+            Requests dequeued after expires (epoch seconds) are answered with
+            hits=None unsearched.
+            n_neighbors > 0 asks for a k-NN search (cut off at radius) instead
+            of a range search. Precomputed centroids may be wider than nprobe
+            (the nearest nprobe centroids come first). Large query batches and hits travel
+            through shared-memory segments (see shm_ipc.share_arrays): only
+            segment descriptors are pickled over the pipe and queue.
+
+        :param generation: Unique per loaded shard (invalidates cached results
+            when a shard with the same name is deployed again)
+        :param load_slots: Shared semaphore that bounds concurrent index reads
+        :param prefetch: Read ahead the on-disk lists probed by each search
+            (with precomputed centroids) before scanning them
+        """
         super().__init__(name=shard_name)
         self.daemon = daemon
+        self.generation = generation
+        self.parent_pid = os.getpid()
 
-        try:
-            self.index = faiss.read_index(shard_path)
-        except RuntimeError:
-            self.index = faiss.read_index(shard_path, faiss.IO_FLAG_ONDISK_SAME_DIR)
-        self.index.nprobe = nprobe
+        self.shard_path = str(shard_path)
+        self.nprobe = nprobe
+        self.index = None
+        self.nonempty = None    # Bool mask of non-empty inverted lists
+        self.load_slots = load_slots
+        self.prefetch = prefetch
         self.input = input_pipe
         self.output = output_queue
 
+    @staticmethod
+    def load_index(shard_path: str, nprobe: int = 4):
+        return read_shard(shard_path, nprobe)
+
     def run(self):
 
-        @faiss_cache(64)
-        def neighborhood(index, query, radius):
-            _, ddd, iii = index.range_search(query, radius)
-            return ddd, iii
+        def neighborhood(index, queries, radius, coarse=None):
+            if coarse is None:
+                return index.range_search(queries, radius)
+            return range_search_preassigned(index, queries, radius, coarse)
+
+        def nearest(index, queries, n_neighbors, radius, coarse=None):
+            """ k-NN search, then hits beyond radius are dropped (range_search layout) """
+            if coarse is None:
+                D, I = index.search(queries, n_neighbors)
+            else:
+                D, I = search_preassigned(index, queries, n_neighbors, coarse)
+            within = (I >= 0) & (D < radius)
+            lims = np.zeros(len(queries) + 1, dtype=np.uint64)
+            np.cumsum(within.sum(axis=1), out=lims[1:])
+            return lims, D[within], I[within]
+
+        if self.load_slots is not None:
+            self.load_slots.acquire()
+        try:
+            self.index = self.load_index(self.shard_path, self.nprobe)
+            self.nonempty = list_sizes(faiss.extract_index_ivf(self.index)) > 0
+        except Exception:
+            traceback.print_exc()
+            print(f'Could not load shard: {self.name}')
+            self.index = None
+        finally:
+            if self.load_slots is not None:
+                self.load_slots.release()
+        self.output.put((None, 'loaded', self.name, self.generation, self.index is not None,
+                         self.index.ntotal if self.index is not None else 0, self.nonempty))
+
+        # Request/response loop
+        while True:
+            try:
+                # Forked siblings hold the handler end of this pipe too, so
+                # recv() may never see EOF: exit once the coordinator is gone
+                if not self.input.poll(1.0):
+                    if os.getppid() != self.parent_pid:
+                        break
+                    continue
+                request = self.input.recv()
+            except (EOFError, KeyboardInterrupt):
+                break
+            if request is None:
+                break
+
+            if request[0] == 'warmup':
+                _, list_ids, max_bytes = request
+                try:
+                    n_bytes = warm_lists(self.index, list_ids, max_bytes) \
+                        if self.index is not None else 0
+                except Exception:
+                    traceback.print_exc()
+                    n_bytes = 0
+                self.output.put((None, 'warmed', self.name, n_bytes))
+                continue
+
+            if request[0] == 'tier':
+                hot = request[1]
+                n_bytes = 0
+                try:
+                    if self.index is not None:
+                        n_bytes = self.set_tier(hot)
+                except Exception:
+                    traceback.print_exc()
+                    print(f'Could not {"promote" if hot else "demote"} shard: {self.name}')
+                self.output.put((None, 'tiered', self.name, hot, n_bytes))
+                continue
+
+            (ticket, queries, rows, k, radius_limit, by_doc, n_neighbors, nprobe, expires) = request
+            if self.index is None or (expires is not None and time() > expires):
+                self.output.put((ticket, self.name, None))
+                continue
+            try:
+                # Views of the coordinator's segment (rows: uncached queries)
+                query_vectors, coarse_dis, coarse_ids = load_arrays(queries)
+                if rows is not None:
+                    query_vectors = query_vectors[rows]
+                    if coarse_ids is not None:
+                        coarse_dis, coarse_ids = coarse_dis[rows], coarse_ids[rows]
+                coarse = None
+                if coarse_ids is not None:
+                    # Empty lists are skipped by faiss (list id -1)
+                    coarse_ids = coarse_ids[:, :nprobe]
+                    coarse_ids = np.where(self.nonempty[np.maximum(coarse_ids, 0)],
+                                          coarse_ids, -1)
+                    coarse = (coarse_dis[:, :nprobe], coarse_ids)
+                    if self.prefetch:
+                        prefetch_probed(self.index, coarse_ids)
+                self.index.nprobe = nprobe
+                if n_neighbors:
+                    lims, dd, ii = nearest(self.index, query_vectors, n_neighbors,
+                                           radius_limit, coarse)
+                else:
+                    lims, dd, ii = neighborhood(self.index, query_vectors, radius_limit, coarse)
+                hits = share_arrays(list(self.sort_hits(lims, dd, ii, k, by_doc)))
+            except Exception:
+                # Always reply (hits=None), otherwise the handler waits forever
+                traceback.print_exc()
+                print(f'Search failed on shard: {self.name}')
+                hits = None
+            self.output.put((ticket, self.name, hits))
 
-        if self.input.poll():
-            (query_vector, radius_limit) = self.input.recv()
-            dd, ii = neighborhood(self.index, query_vector, radius_limit)
-            self.output.put((dd, ii), block=False)
+    def set_tier(self, hot: bool) -> int:
+        """
+        Hot: Copies the inverted lists into RAM (bounded like index reads)
+        Cold: Re-reads the index (inverted lists searched on-disk)
+        :return: Bytes of inverted lists held in RAM
+        """
+        if not hot:
+            if ram_resident(self.index):
+                self.index = self.load_index(self.shard_path, self.nprobe)
+            return 0
+
+        if self.load_slots is not None:
+            self.load_slots.acquire()
+        try:
+            return promote_to_ram(self.index)
+        finally:
+            if self.load_slots is not None:
+                self.load_slots.release()
+
+    @staticmethod
+    def sort_hits(lims: np.array, D: np.array, I: np.array, k: int,
+                  by_doc: bool = False):
+        """
+        Sorts each query's range search hits by score and keeps the best k.
+        :param by_doc: Keep every hit of the best k docs instead
+            (see BaseIndexer.top_k_docs)
+        :return: lims, distances, labels (same layout as index.range_search)
+        """
+        new_lims = np.zeros_like(lims)
+        DD, II = list(), list()
+        for q in range(len(lims) - 1):
+            dd, ii = D[lims[q]:lims[q + 1]], I[lims[q]:lims[q + 1]]
+            if by_doc:
+                dd, ii, _ = BaseIndexer.top_k_docs(dd, ii, k)
+                DD.append(dd), II.append(ii)
+                new_lims[q + 1] = new_lims[q] + len(dd)
+                continue
+            if len(dd) > k:
+                top_k = np.argpartition(dd, k - 1)[:k]
+                dd, ii = dd[top_k], ii[top_k]
+            order = np.argsort(dd, kind='stable')
+            DD.append(dd[order]), II.append(ii[order])
+            new_lims[q + 1] = new_lims[q] + len(order)
+        if not DD:
+            return new_lims, D[:0], I[:0]
+        return new_lims, np.concatenate(DD), np.concatenate(II)
 
 
 class RangeShards(BaseIndexer):
+    search_modes = ('range', 'knn')
+
     def __init__(self, shard_dir: Union[str, Path], nprobe: int = 4,
-                 get_nested: bool = False):
+                 get_nested: bool = False, base_index_path: Union[str, Path] = None,
+                 preassign: bool = True, cache_size: int = 8192,
+                 cache_bytes: int = 2**29, load_workers: int = 8,
+                 lazy: bool = False, eager_days: int = 180,
+                 warmup_days: int = 0, warmup_bytes: int = 2**30,
+                 warmup_rate: float = 2**27, warmup_timeout: float = 600,
+                 query_log: np.array = None, hot_bytes: int = 0, hot_days: int = 7,
+                 retier_interval: float = 600, retention_days: int = 0,
+                 retention_interval: float = 3600, knn_factor: int = 4,
+                 nprobe_tuner: NprobeTuner = None, prefetch: bool = True):
         """
         For deploying multiple, pre-made IVF indexes as shards.
             (intended for on-disk indexes that do not fit in memory)
 
         Note: The index shards must be true partitions with no overlapping ids
 
+        Searches run concurrently: every request is tagged with a ticket,
+        and a collector thread routes worker replies back to the request.
+        Shard additions swap in a new shard dict under a write lock, so
+        in-flight searches keep the shards they started with.
+
+        Each shard's hits are cached per query vector, so a date window that
+        overlaps earlier searches only sends the new days to the workers.
+
+        Shards are selected by date through a ShardCatalog (a bisect over
+        date-sorted shard names), built once and updated by add_shard.
+
+        Shard workers read their indexes in the background (newest first,
+        at most load_workers at once); searches that reach a shard before
+        it is read wait for it. In lazy mode, shards older than eager_days
+        are only opened by the first search that selects their date.
+
+        Warmup (warmup_days > 0) asks the kernel to read the .ivfdata of
+        the most recent shards into the page cache in the background, at
+        startup and after add_shard. The most probed centroids' lists are
+        read first (probes are counted per query, seeded by query_log).
+
+        Tiering (hot_bytes > 0) holds shards in RAM (as ArrayInvertedLists)
+        within a memory budget: shards dated within hot_days of the newest
+        shard first, then the most queried older shards. The hot set is
+        re-planned every retier_interval seconds and after add_shard;
+        demoted shards are searched on-disk again.
+
+        Retention (retention_days > 0) takes shards dated more than
+        retention_days before today offline (checked every
+        retention_interval seconds), stopping their workers. Callables in
+        self.on_evict are then called with the evicted shard names (e.g.
+        to clear caches of results that include them).
+
+        Each search visits nprobe_tuner.nprobe(shard size) centroids per shard
+        (scaled down while searches miss the tuner's latency SLO), unless the
+        request sets nprobe for every shard. Only single-query searches count
+        towards the SLO (batches from offline jobs do not lower nprobe).
+
+        Queries whose probed centroids all have empty inverted lists in a
+        shard are not sent to it (list masks come from the ShardManifest, or
+        from the worker once loaded); workers skip probed lists that are empty.
+
+        Every on-disk shard worker asks the kernel to read ahead all of the
+        lists a search probes before scanning them (with precomputed
+        centroids), so the reads of every selected shard are in flight at
+        once rather than faulted in one list at a time.
+
+        partial_search() answers within a deadline: shards are asked newest
+        first, and the date ranges of shards that did not answer in time are
+        reported with the (partial) results.
+
+        Searches run in one of two modes:
+            'range': every hit within radius (unbounded per-shard work)
+            'knn': each shard's k nearest hits within radius (k * knn_factor
+                when grouping by doc, since docs hold many hits)
+
         :param shard_dir: Dir containing faiss index shards
         :param nprobe: Number of clusters to visit during search
                        (speed accuracy trade-off)
         :param get_nested: Load indexes in sub directories of shard_dir
+        :param base_index_path: Pre-trained base index the shards were built
+            from (optional: the coarse quantizer is otherwise read from a shard)
+        :param preassign: Search the shared coarse quantizer once per query
+            and send its centroids to every shard
+        :param cache_size: Number of (shard, query) results to keep cached
+        :param cache_bytes: Memory budget of the shard result cache
+        :param load_workers: Number of shards read concurrently
+        :param lazy: Defer opening shards older than eager_days
+        :param eager_days: Shards dated within this many days of today
+            are opened at startup in lazy mode (Default: the service's
+            maximum date-range)
+        :param warmup_days: Warm shards dated within this many days of the
+            newest shard (0: no warmup)
+        :param warmup_bytes: I/O budget of each warmup
+        :param warmup_rate: Maximum warmup read rate (bytes per second)
+        :param warmup_timeout: Seconds to wait for a shard's warmup before
+            moving on to the next shard
+        :param query_log: Past query vectors (n, dim) used to rank centroids
+        :param hot_bytes: Memory budget of RAM-resident shards (0: all on-disk)
+            Each RangeShards holds its own copy of its hot shards (split a
+            budget across pre-forked server workers)
+        :param hot_days: Shards dated within this many days of the newest
+            shard are held in RAM first
+        :param retier_interval: Seconds between hot set updates
+        :param retention_days: Evict shards older than this many days
+            (0: keep every shard)
+        :param retention_interval: Seconds between retention checks
+        :param knn_factor: Hits per doc budgeted by 'knn' searches grouped by doc
+        :param nprobe_tuner: Picks nprobe per shard size and under load
+            (Default: nprobe for every shard)
+        :param prefetch: Shard workers read ahead the inverted lists each
+            search probes (see warmup.prefetch_probed)
         """
         super().__init__()
         self.paths_to_shards = self.get_index_paths(shard_dir, recursive=get_nested)
         self.nprobe = nprobe
+        self.knn_factor = knn_factor
+        self.tuner = nprobe_tuner or NprobeTuner(default_nprobe=nprobe)
+        self.shard_sizes = dict()
+        self.list_masks = dict()    # Shard name: bool mask of non-empty inverted lists
+        self.prefetch = prefetch
         self.dynamic = True
-        self.lock = False
-        self.date_seed = str('\d{4}[-/]\d{2}[-/]\d{2}')
+        self.lock = ReadWriteLock()
+        self.catalog = ShardCatalog()
+
+        # Shards must be named by publication date (YYYY-MM-DD)
+        for shard_path in list(self.paths_to_shards):
+            try:
+                ShardCatalog.shard_date(shard_path)
+            except ValueError:
+                print(f'WARNING: Skipping shard without an ISO date: {shard_path}')
+                self.paths_to_shards.remove(shard_path)
+
+        # All shards share the coarse quantizer of their base index
+        if preassign and not self.shares_base_index(self.paths_to_shards):
+            print('WARNING: Shards were built from different base indexes \n'
+                  '         Coarse preassignment is disabled')
+            preassign = False
+        self.preassign = preassign
+        self.quantizer = None
+        if preassign and (base_index_path or self.paths_to_shards):
+            self.quantizer = load_quantizer(base_index_path or self.paths_to_shards[0])
+        self.read_list_masks(self.paths_to_shards)
 
+        # Worker replies are routed to pending searches by ticket
         self.results = Queue()
+        self.tickets = count()
+        self.pending = dict()
+        self.pending_lock = Lock()
+        self.collector = Thread(target=self.collect_results, daemon=True)
+        self.collector.start()
+
+        # Key: (shard name, shard generation, query vector key, radius)
+        self.shard_cache = LRUCache(cache_size, max_bytes=cache_bytes)
+        self.generations = count()
+
+        # Shard name: True once read (False if it failed to load)
+        self.loaded = dict()
+        self.load_cond = Condition()
+        self.load_slots = BoundedSemaphore(max(1, load_workers))
+
+        # Lazy shards are registered with handler None until first searched
+        self.shard_paths = dict()
+        self.open_lock = Lock()
+        eager_from = date.isoformat(date.today() - timedelta(eager_days)) \
+            if lazy else '0000-00-00'
+
         self.shards = dict()
+        self.shard_bytes = dict()
         self.n_shards = 0
-        for shard_path in self.paths_to_shards:
-            self.load_shard(shard_path)
-        for shard_name, (handler_pipe, shard) in self.shards.items():
-            shard.start()
+        for shard_path in sorted(self.paths_to_shards, reverse=True,
+                                 key=ShardCatalog.shard_date):
+            shard_name = str(shard_path).replace('.index', '')
+            if ShardCatalog.shard_date(shard_path) >= eager_from:
+                shard_name, handler = self.load_shard(shard_path)
+            else:
+                handler = None
+            self.shards[shard_name] = handler
+            self.shard_paths[shard_name] = shard_path
+            self.shard_bytes[shard_name] = self.measure_shard(shard_path)
+            self.catalog.add(shard_name)
             self.n_shards += 1
+        atexit.register(self.close)
+
+        # Page-cache warmup (serialized on one background thread)
+        self.warmup_days = warmup_days
+        self.warmup_bytes = warmup_bytes
+        self.warmup_rate = warmup_rate
+        self.warmup_timeout = warmup_timeout
+        self.warm_jobs = ThreadQueue()
+        self.warm_replies = ThreadQueue()
+        self.warmer = None
+        self.probe_counts = None
+        if self.quantizer is not None:
+            self.probe_counts = np.zeros(self.quantizer.ntotal, dtype=np.int64)
+            if query_log is not None and len(query_log):
+                self.count_probes(coarse_assign(self.quantizer, query_log, self.nprobe))
+        if warmup_days:
+            self.warmup()
+
+        # Hot/cold tiering (re-planned on a background thread)
+        self.hot_bytes = hot_bytes
+        self.hot_days = hot_days
+        self.retier_interval = retier_interval
+        self.shard_queries = Counter()
+        self.queries_lock = Lock()      # Search threads count, retier() reads
+        self.hot_shards = set()
+        self.tier_bytes = dict()
+        self.retier_event = Event()
+        self.closing = False
+        self.tierer = None
+        if hot_bytes:
+            self.tierer = Thread(target=self.run_tiering, daemon=True)
+            self.tierer.start()
+
+        # Rolling retention window
+        self.retention_days = retention_days
+        self.retention_interval = retention_interval
+        self.on_evict = list()
+        self.stop_event = Event()
+        if retention_days:
+            self.evict_expired()
+            Thread(target=self.run_retention, daemon=True).start()
 
-    @faiss_cache(256)
     def search(self, query_vector: np.array, k: int, radius: float = 0.65,
-               start: str = '0000-00-00', end: str = '9999-99-99'
+               start: str = '0000-00-00', end: str = '9999-99-99',
+               by_doc: bool = False, mode: str = 'range', nprobe: int = None
                ) -> FaissSearch:
+        query_vector = np.reshape(query_vector, (1, query_vector.shape[-1]))
+        return self.batch_search(query_vector, k=k, radius=radius, start=start, end=end,
+                                 by_doc=by_doc, mode=mode, nprobe=nprobe)[0]
 
-        if len(query_vector.shape) < 2 or query_vector.shape[0] > 1:
-            query_vector = np.reshape(query_vector, (1, query_vector.shape[0]))
+    def batch_search(self, query_vectors: np.array, k: int, radius: float = 0.65,
+                     start: str = '0000-00-00', end: str = '9999-99-99',
+                     by_doc: bool = False, mode: str = 'range', nprobe: int = None
+                     ) -> List[FaissSearch]:
+        """
+        Range searches many queries with one request per shard (nq > 1).
+        :param query_vectors: Query embeddings shaped (n_queries, dim)
+        :param k: Number of hits kept per query (global top-k across shards)
+        :param radius: Maximum L2 distance between a query and a hit
+        :param start: Search shards corresponding to this date and beyond
+        :param end: Limit date-range search up to this YYYY-MM-DD
+        :param by_doc: Keep every hit of the best k docs instead of the best
+            k hits. Shard workers group their own hits by doc, so only
+            their top-k docs are sent back and merged.
+        :param mode: 'range' (all hits within radius) or 'knn' (bounded
+            nearest neighbor search per shard, hits beyond radius dropped)
+        :param nprobe: Centroids visited on every shard (Default: see nprobe_tuner)
+        :return: One (scores, ids) search result per query
+            (by_doc: hits ordered by doc, docs ordered by their best score)
+        """
+        return self.partial_search(query_vectors, k=k, radius=radius, start=start, end=end,
+                                   by_doc=by_doc, mode=mode, nprobe=nprobe)[0]
+
+    def partial_search(self, query_vectors: np.array, k: int, radius: float = 0.65,
+                       start: str = '0000-00-00', end: str = '9999-99-99',
+                       by_doc: bool = False, mode: str = 'range', nprobe: int = None,
+                       deadline: float = None) -> Tuple[List[FaissSearch], List[DateRange]]:
+        """
+        batch_search() that answers within a deadline.
+            Shards are asked newest first. Once deadline seconds have passed,
+            the hits gathered so far are merged and returned; shards that
+            have not answered drop the request instead of searching.
+        :param deadline: Seconds to wait for shards (Default: wait for all)
+        :return: One (scores, ids) search result per query,
+            (start, end) date ranges of the shards not searched (or failed)
+        """
+        t_0 = time()
+        expires = t_0 + deadline if deadline is not None else None
+        if mode not in self.search_modes:
+            raise ValueError(f'Unknown search mode: {mode} (expected one of {self.search_modes})')
+        n_neighbors = 0
+        if mode == 'knn':
+            n_neighbors = k * self.knn_factor if by_doc else k
+        doc_capped = bool(n_neighbors) and by_doc
+
+        query_vectors = np.ascontiguousarray(query_vectors, dtype=np.float32)
+        if len(query_vectors.shape) < 2:
+            query_vectors = np.reshape(query_vectors, (1, query_vectors.shape[0]))
+        n_queries = query_vectors.shape[0]
+
+        # Shards visit at most every centroid (one cache key per effective nprobe)
+        nlist = self.quantizer.ntotal if self.quantizer is not None else None
+        if nprobe is not None and nlist is not None:
+            nprobe = min(nprobe, nlist)
+
+        # Reuse cached hits of every (shard, query) searched before
+        query_keys = [array_key(query_vectors[q]) for q in range(n_queries)]
+        shard_hits = [list() for _ in range(n_queries)]
+        sent = dict()
+        queries = None
+
+        ticket = next(self.tickets)
+        replies = ThreadQueue()
+        with self.pending_lock:
+            self.pending[ticket] = replies
+
+        try:
+            with self.lock.read_locked():
+                requests = list()
+                selected = self.catalog.select(start, end)
+                searched = set()
+                for shard_name in reversed(selected):   # Newest first
+                    handler = self.shards[shard_name]   # None: lazy shard not opened yet
+                    with self.queries_lock:
+                        self.shard_queries[shard_name] += n_queries
+                    shard_nprobe = nprobe or self.tuner.nprobe(self.shard_sizes.get(shard_name),
+                                                               nlist)
+                    rows = list()
+                    for q in range(n_queries):
+                        if handler is None:
+                            rows.append(q)
+                            continue
+                        cache_key = (shard_name, handler[1].generation, query_keys[q],
+                                     radius, by_doc, mode, shard_nprobe)
+                        cached = self.shard_cache.get(cache_key)
+                        # Cached hits hold the best cached_k (or all) hits/docs. Fewer
+                        # than cached_k means all, unless k-NN capped docs (knn_factor)
+                        if cached is not None and (cached[0] >= k or
+                                                   (cached[1] < cached[0] and not doc_capped)):
+                            if by_doc:
+                                shard_hits[q].append(self.top_k_docs(cached[2], cached[3], k)[:2])
+                            else:
+                                shard_hits[q].append((cached[2][:k], cached[3][:k]))
+                        else:
+                            rows.append(q)
+                    if rows:
+                        requests.append((shard_name, handler, rows, shard_nprobe))
+                    else:
+                        searched.add(shard_name)    # Fully cached
+
+                # Coarse quantization is identical for every shard: do it once
+                # (as wide as the largest nprobe, shards read a prefix)
+                coarse = None
+                if self.quantizer is not None and requests:
+                    coarse = coarse_assign(self.quantizer, query_vectors,
+                                           max(request[3] for request in requests))
+                    self.count_probes(coarse)
+                    requests = self.skip_empty_lists(requests, coarse, searched)
+
+                # Written once, read by every shard worker (pickled only if small)
+                if requests:
+                    queries = share_arrays([query_vectors] +
+                                           ([None, None] if coarse is None else list(coarse)))
+
+                # Fan out: every shard worker searches concurrently
+                for shard_name, handler, rows, shard_nprobe in requests:
+                    hpipe, shard, pipe_lock = handler or self.open_shard(shard_name)
+                    if not shard.is_alive() and shard.exitcode is not None:
+                        continue    # Dead worker: skipped
+                    try:
+                        with pipe_lock:
+                            hpipe.send((ticket, queries, rows if len(rows) < n_queries else None,
+                                        k, radius, by_doc, n_neighbors, shard_nprobe, expires))
+                    except (BrokenPipeError, OSError):
+                        continue    # Dead worker: skipped
+                    sent[shard_name] = (shard, rows, shard_nprobe)
 
-        # Lock search while loading index or actively searching
-        while self.lock:
-            sleep(1)
+            # Gather sorted shard hits (waits on the slowest shard, not the sum)
+            outstanding = set(sent)
+            while outstanding:
+                try:
+                    wait = 1.0 if expires is None else min(1.0, max(expires - time(), 0))
+                    shard_name, shard_result = replies.get(timeout=wait)
+                except Empty:
+                    if expires is not None and time() >= expires:
+                        break   # Deadline: late replies are dropped by the collector
+                    # Workers that died will not answer: skipped
+                    outstanding -= {shard_name for shard_name in outstanding
+                                    if not sent[shard_name][0].is_alive()}
+                    continue
+                outstanding.discard(shard_name)
+                if shard_result is None:
+                    continue    # Failed (or expired) shard: skipped (and not cached)
+                searched.add(shard_name)
+                lims, dd, ii = load_arrays(shard_result, unlink=True)
+                shard, rows, shard_nprobe = sent[shard_name]
+                generation = shard.generation
+                for j, q in enumerate(rows):
+                    hits = (dd[lims[j]:lims[j + 1]].copy(), ii[lims[j]:lims[j + 1]].copy())
+                    shard_hits[q].append(hits)
+                    n_hits = len(np.unique(hits[1] // 10000)) if by_doc else len(hits[0])
+                    cache_key = (shard_name, generation, query_keys[q],
+                                 radius, by_doc, mode, shard_nprobe)
+                    self.shard_cache.put(cache_key, (k, n_hits) + hits)
+        finally:
+            with self.pending_lock:
+                del self.pending[ticket]
+            if isinstance(queries, SharedArrays):
+                queries.unlink()
 
-        # Lock out other searches
-        self.lock = True
+        # Bounded k-way merge (by_doc: regroup the shards' top docs)
+        results = list()
+        for q in range(n_queries):
+            if by_doc and shard_hits[q]:
+                D, I, _ = self.top_k_docs(np.concatenate([dd for dd, _ in shard_hits[q]]),
+                                          np.concatenate([ii for _, ii in shard_hits[q]]), k)
+            else:
+                D, I = self.merge_top_k(shard_hits[q], k)
+            results.append(([D], [I]))
 
-        # Start parallel range search
-        n_results = 0
-        for shard_name, (hpipe, shard) in self.shards.items():
-            shard_date = re.search(self.date_seed, shard_name).group()
-            if start <= shard_date <= end:
-                hpipe.send((query_vector, radius))
-                shard.run()
-                n_results += 1
+        if nprobe is None and n_queries == 1:
+            self.tuner.observe(time() - t_0)
+        if len(searched) == len(selected):
+            return results, list()
+        skipped = set(selected) - searched
+        return results, ShardCatalog.date_ranges(selected, skipped)
 
-        # Aggregate results
-        D, I = list(), list()
-        while n_results > 0 or not self.results.empty():
-            dd, ii = self.results.get()
-            D.extend(dd[:k]), I.extend(ii[:k])
-            n_results -= 1
+    def read_list_masks(self, shard_paths: List[Union[str, Path]]):
+        """ Non-empty inverted lists of the shards recorded in ShardManifests """
+        manifests = dict()
+        for shard_path in shard_paths:
+            index_dir = Path(shard_path).parent
+            if index_dir not in manifests:
+                manifests[index_dir] = ShardManifest(index_dir) \
+                    if ShardManifest.exists(index_dir) else None
+            entry = manifests[index_dir].get(shard_path) if manifests[index_dir] else None
+            if entry is not None:
+                self.set_list_mask(str(shard_path).replace('.index', ''),
+                                   ShardManifest.nonempty_lists(entry))
 
-        self.lock = False
-        return self.joint_sort([D], [I])
+    def set_list_mask(self, shard_name: str, nonempty: np.array):
+        """ Masks must match the shared quantizer (one bit per centroid) """
+        if nonempty is not None and self.quantizer is not None \
+                and len(nonempty) == self.quantizer.ntotal:
+            self.list_masks[shard_name] = nonempty
+
+    def skip_empty_lists(self, requests: list, coarse: CoarseAssignment,
+                         searched: set) -> list:
+        """
+        Drops the queries that only probe empty inverted lists of a shard
+            (daily shards leave many lists of the base index empty).
+            Shards left without queries are not searched (nor opened).
+        :param requests: (shard name, handler, rows, nprobe) per shard
+        :param searched: Shards with nothing to search are added to it
+        :return: Requests that may find hits
+        """
+        kept = list()
+        for shard_name, handler, rows, shard_nprobe in requests:
+            nonempty = self.list_masks.get(shard_name)
+            if nonempty is not None:
+                probed = coarse[1][rows, :shard_nprobe]
+                useful = (nonempty[np.maximum(probed, 0)] & (probed >= 0)).any(axis=1)
+                rows = [q for q, use in zip(rows, useful) if use]
+            if rows:
+                kept.append((shard_name, handler, rows, shard_nprobe))
+            else:
+                searched.add(shard_name)    # No hits possible
+        return kept
+
+    def collect_results(self):
+        """ Routes worker replies to their pending searches (collector thread) """
+        while True:
+            reply = self.results.get()
+            if reply is None:
+                break
+            ticket, result = reply[0], reply[1:]
+            if ticket is None:
+                if result[0] == 'loaded':
+                    self.mark_loaded(*result[1:])
+                elif result[0] == 'warmed':
+                    self.warm_replies.put(result[1:])
+                elif result[0] == 'tiered':
+                    self.mark_tiered(*result[1:])
+                continue
+            with self.pending_lock:
+                replies = self.pending.get(ticket)
+            if replies is not None:
+                replies.put(result)
+            elif isinstance(result[1], SharedArrays):
+                result[1].unlink()  # Abandoned search: free its segment
+
+    def mark_loaded(self, shard_name: str, generation: int, loaded: bool, n_vectors: int = 0,
+                    nonempty: np.array = None):
+        with self.load_cond:
+            self.loaded[shard_name] = loaded
+            if loaded:
+                self.shard_sizes[shard_name] = n_vectors
+                self.set_list_mask(shard_name, nonempty)
+            self.load_cond.notify_all()
+
+    def load_status(self) -> dict:
+        """ Counts shards by state: loaded, failed, loading, unopened """
+        shards = self.shards
+        with self.load_cond:
+            n_loaded = sum(self.loaded.get(name, False) for name in shards)
+            n_failed = sum(self.loaded.get(name) is False for name in shards)
+        n_unopened = sum(handler is None for handler in shards.values())
+        return {'loaded': n_loaded, 'failed': n_failed,
+                'loading': len(shards) - n_loaded - n_failed - n_unopened,
+                'unopened': n_unopened}
+
+    def wait_until_loaded(self, timeout: float = None) -> bool:
+        """ Blocks until every opened shard has been read (or timeout) """
+        with self.load_cond:
+            return self.load_cond.wait_for(
+                lambda: not self.load_status()['loading'], timeout)
+
+    def open_shard(self, shard_name: str):
+        """ Starts the worker of a lazy shard (called under the read lock) """
+        with self.open_lock:
+            handler = self.shards.get(shard_name)
+            if handler is None:
+                _, handler = self.load_shard(self.shard_paths[shard_name])
+                self.shards[shard_name] = handler
+        return handler
 
     def load_shard(self, shard_path: Union[str, Path]):
         shard_name = str(shard_path).replace('.index', '')
         shard_pipe, handler_pipe = Pipe(False)
         shard = Shard(shard_name, str(shard_path),
                       input_pipe=shard_pipe, output_queue=self.results,
-                      nprobe=self.nprobe, daemon=False)
-        self.shards[shard_name] = (handler_pipe, shard)
+                      nprobe=self.nprobe, daemon=True,
+                      generation=next(self.generations),
+                      load_slots=self.load_slots, prefetch=self.prefetch)
+        shard.start()
+        return shard_name, (handler_pipe, shard, Lock())
 
     def add_shard(self, new_shard_path: Union[str, Path]):
-        # Lock search while deploying a new shard
-        self.lock = True
-
         shard_name = str(new_shard_path).replace('.index', '')
         if new_shard_path in self.paths_to_shards or \
                 shard_name in self.shards:
             print('WARNING: This shard is already online \n'
                   '         Aborting...')
+            return
+        ShardCatalog.shard_date(new_shard_path)     # Raises ValueError if undated
+
+        # Start the worker before locking: searches continue meanwhile
+        shard_name, handler = self.load_shard(new_shard_path)
+        if self.preassign and not self.shares_base_index(
+                list(self.paths_to_shards) + [new_shard_path]):
+            print('WARNING: New shard was built from a different base index \n'
+                  '         Coarse preassignment is disabled')
+            self.preassign, self.quantizer = False, None
+        if self.quantizer is None and self.preassign:
+            self.quantizer = load_quantizer(new_shard_path)
+        self.read_list_masks([new_shard_path])
+
+        # Swap in the new shard atomically
+        with self.lock.write_locked():
+            shards = dict(self.shards)
+            shards[shard_name] = handler
+            self.shards = shards
+            self.shard_paths[shard_name] = new_shard_path
+            self.shard_bytes[shard_name] = self.measure_shard(new_shard_path)
+            self.catalog.add(shard_name)
+            self.paths_to_shards = self.paths_to_shards + [new_shard_path]
+            self.n_shards += 1
+        if self.warmup_days:
+            self.warmup([shard_name])
+        if self.hot_bytes:
+            self.retier_event.set()
+
+    def remove_shard(self, shard_path: Union[str, Path]) -> bool:
+        """
+        Takes a shard offline and stops its worker.
+            Searches already sent to the shard are answered first.
+        :param shard_path: /full/path/to/shard.index (or its shard name)
+        :return: True if the shard was deployed
+        """
+        shard_name = str(shard_path).replace('.index', '')
+        with self.lock.write_locked():
+            if shard_name not in self.shards:
+                return False
+            shards = dict(self.shards)
+            handler = shards.pop(shard_name)
+            self.shards = shards
+            self.catalog.remove(shard_name)
+            removed_path = self.shard_paths.pop(shard_name)
+            self.paths_to_shards = [path for path in self.paths_to_shards
+                                    if path != removed_path]
+            self.shard_bytes.pop(shard_name, None)
+            self.n_shards -= 1
+        self.hot_shards = self.hot_shards - {shard_name}
+        self.tier_bytes.pop(shard_name, None)
+        with self.queries_lock:
+            self.shard_queries.pop(shard_name, None)
+        self.shard_sizes.pop(shard_name, None)
+        self.list_masks.pop(shard_name, None)
+
+        if handler is not None:
+            self.stop_worker(handler)
+        return True
+
+    @staticmethod
+    def stop_worker(handler: tuple, timeout: float = 5):
+        hpipe, shard, pipe_lock = handler
+        if shard.is_alive():
+            try:
+                with pipe_lock:
+                    hpipe.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        shard.join(timeout=timeout)
+        if shard.is_alive():
+            shard.terminate()
+
+    def evict_expired(self) -> List[str]:
+        """ :return: Shards evicted for falling outside the retention window """
+        oldest = date.isoformat(date.today() - timedelta(self.retention_days))
+        expired = [name for name in self.catalog.select(end=oldest)
+                   if ShardCatalog.shard_date(name) < oldest]
+        for shard_name in expired:
+            self.remove_shard(shard_name)
+            print(f'Evicted shard older than {self.retention_days} days: {shard_name}')
+        if expired:
+            for callback in list(self.on_evict):
+                callback(expired)
+        return expired
+
+    def run_retention(self):
+        """ Retention thread: evicts expired shards every retention_interval """
+        while not self.stop_event.wait(self.retention_interval):
+            try:
+                self.evict_expired()
+            except Exception:
+                traceback.print_exc()
+
+    @staticmethod
+    def measure_shard(shard_path: Union[str, Path]) -> int:
+        """ :return: Approximate bytes of a shard's inverted lists """
+        ivfdata_path = str(shard_path).replace('.index', '.ivfdata')
+        try:
+            return os.stat(ivfdata_path).st_size
+        except FileNotFoundError:
+            return os.stat(str(shard_path)).st_size
+
+    def recent_since(self, days: int) -> Union[str, None]:
+        """ :return: ISO date days - 1 before the newest shard (None if empty) """
+        _, newest = self.catalog.date_range()
+        if newest is None:
+            return None
+        newest = date(*(int(ymd) for ymd in newest.split('-')))
+        return date.isoformat(newest - timedelta(max(days - 1, 0)))
+
+    def run_tiering(self):
+        """ Tiering thread: re-plans the hot set periodically and on demand """
+        while not self.closing:
+            try:
+                self.retier()
+            except Exception:
+                traceback.print_exc()
+            self.retier_event.wait(self.retier_interval)
+            self.retier_event.clear()
+
+    def retier(self):
+        """ Promotes/demotes shards to fit the hot set in hot_bytes """
+        hot_since = self.recent_since(self.hot_days)
+        if hot_since is None:
+            return
+        shards = self.shards
+        with self.queries_lock:
+            shard_queries = dict(self.shard_queries)
+        usage = [(name, ShardCatalog.shard_date(name), self.shard_bytes.get(name, 0),
+                  shard_queries.get(name, 0))
+                 for name, handler in shards.items() if handler is not None]
+        hot = plan_hot_shards(usage, hot_since, self.hot_bytes)
+
+        # Demote first (frees memory for promotions)
+        for shard_name in sorted(self.hot_shards - hot) + sorted(hot - self.hot_shards):
+            handler = shards.get(shard_name)
+            if handler is None:
+                continue
+            hpipe, shard, pipe_lock = handler
+            try:
+                with pipe_lock:
+                    hpipe.send(('tier', shard_name in hot))
+            except (BrokenPipeError, OSError):
+                pass
+        self.hot_shards = hot
+
+        # Older queries count half as much each round
+        with self.queries_lock:
+            self.shard_queries = Counter({name: n / 2 for name, n
+                                          in self.shard_queries.items() if n >= 1})
+
+    def mark_tiered(self, shard_name: str, hot: bool, n_bytes: int):
+        if hot:
+            self.tier_bytes[shard_name] = n_bytes
+            self.shard_bytes[shard_name] = n_bytes  # Measured (plans the next round)
         else:
-            self.paths_to_shards.append(new_shard_path)
-            self.load_shard(new_shard_path)
+            self.tier_bytes.pop(shard_name, None)
+
+    def tier_status(self) -> dict:
+        """ RAM-resident shards and the memory they hold """
+        tier_bytes = dict(self.tier_bytes)
+        return {'hot_shards': len(tier_bytes),
+                'hot_bytes': sum(tier_bytes.values()),
+                'max_bytes': self.hot_bytes}
+
+    def count_probes(self, coarse: CoarseAssignment):
+        """ Tallies probed centroids (approximate under concurrent searches) """
+        if self.probe_counts is not None:
+            coarse_ids = coarse[1]
+            np.add.at(self.probe_counts, coarse_ids[coarse_ids >= 0], 1)
+
+    def hot_lists(self) -> Union[np.array, None]:
+        """ :return: Probed list ids (most probed first), None if none probed """
+        if self.probe_counts is None or not self.probe_counts.any():
+            return None
+        probed = np.flatnonzero(self.probe_counts)
+        return probed[np.argsort(-self.probe_counts[probed], kind='stable')]
+
+    def warmup(self, shard_names: List[str] = None, max_bytes: int = None):
+        """
+        Queues a background page-cache warmup.
+        :param shard_names: Shards to warm, newest first (Default: shards
+            dated within warmup_days of the newest shard)
+        :param max_bytes: I/O budget (Default: warmup_bytes)
+        """
+        if shard_names is None:
+            since = self.recent_since(self.warmup_days)
+            if since is None:
+                return
+            shard_names = self.catalog.select(since)[::-1]
+        self.warm_jobs.put((list(shard_names), max_bytes or self.warmup_bytes))
+
+        if self.warmer is None:
+            self.warmer = Thread(target=self.run_warmups, daemon=True)
+            self.warmer.start()
+
+    def run_warmups(self):
+        """ Warmup thread: one shard at a time, within budget and rate """
+        while True:
+            job = self.warm_jobs.get()
+            if job is None:
+                break
+            shard_names, budget = job
+
+            # Most probed centroids first (all lists if nothing was probed)
+            hot_lists = self.hot_lists()
+            list_ids = None if hot_lists is None else hot_lists.tolist()
+            for shard_name in shard_names:
+                handler = self.shards.get(shard_name)
+                if budget <= 0 or handler is None:
+                    continue    # Out of budget, removed or not opened (lazy)
+                hpipe, shard, pipe_lock = handler
+                try:
+                    with pipe_lock:
+                        hpipe.send(('warmup', list_ids, budget))
+                except (BrokenPipeError, OSError):
+                    continue
+                n_bytes = self.await_warmup(shard_name, shard)
+                if n_bytes is None:
+                    print(f'Warmup timed out on shard: {shard_name}')
+                    continue
+                budget -= n_bytes
+                if self.warmup_rate:
+                    sleep(n_bytes / self.warmup_rate)
+
+    def await_warmup(self, shard_name: str, shard: Shard) -> Union[int, None]:
+        """ :return: Bytes warmed by shard_name (None: worker died or timed out) """
+        expires = time() + self.warmup_timeout
+        while shard.is_alive() and time() < expires:
+            try:
+                warmed_name, n_bytes = self.warm_replies.get(
+                    timeout=min(1.0, max(expires - time(), 0)))
+            except Empty:
+                continue
+            if warmed_name == shard_name:
+                return n_bytes
+            # Otherwise: a late reply from a shard that timed out before
+        return None
+
+    def close(self):
+        """ Stops every shard worker """
+        with self.lock.write_locked():
+            shards, self.shards = self.shards, dict()
+            self.catalog = ShardCatalog()
+            self.n_shards = 0
+
+        self.stop_event.set()
+        handlers = [handler for handler in shards.values() if handler is not None]
+        for hpipe, shard, pipe_lock in handlers:
+            if shard.is_alive():
+                try:
+                    with pipe_lock:
+                        hpipe.send(None)
+                except (BrokenPipeError, OSError):
+                    pass
+        for hpipe, shard, pipe_lock in handlers:
+            shard.join(timeout=5)
+            if shard.is_alive():
+                shard.terminate()
+
+        if self.warmer is not None:
+            self.warm_jobs.put(None)
+        if self.tierer is not None:
+            self.closing = True
+            self.retier_event.set()
 
-        # Release lock
-        self.lock = False
+        if self.collector.is_alive():
+            self.results.put(None)
+            self.collector.join(timeout=5)
@@ -0,0 +1,150 @@
+import json
+from pathlib import Path
+from collections import deque
+from threading import Lock
+from typing import Dict, List, Union
+
+import numpy as np
+import faiss
+
+from .base_indexer import read_shard
+
+__all__ = ['NprobeTuner']
+
+
+class NprobeTuner(object):
+    """
+    Chooses how many centroids each shard visits (nprobe).
+        Offline: calibrate() finds, for each shard-size bucket, the smallest
+        nprobe whose recall@k on a held-out query set meets a target
+        (against searching every inverted list of the shard).
+        Online: observe() feeds search latencies to a controller that scales
+        nprobe down while the recent latency percentile exceeds latency_slo,
+        and back up once searches are well within it.
+
+    Shard sizes are bucketed by powers of two: bucket b holds shards of
+        2**(b-1) <= ntotal < 2**b vectors.
+    """
+    candidates = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+    def __init__(self, default_nprobe: int = 4, nprobe_by_bucket: Dict[int, int] = None,
+                 latency_slo: float = None, min_nprobe: int = 1,
+                 window: int = 100, percentile: float = 90):
+        """
+        :param default_nprobe: For shards of unknown or uncalibrated size
+        :param nprobe_by_bucket: Calibrated nprobe per size bucket
+        :param latency_slo: Target latency percentile in seconds (None: off)
+        :param min_nprobe: Lower bound when scaling down under load
+        :param window: Latencies considered per adjustment
+        :param percentile: Latency percentile held under latency_slo
+        """
+        self.default_nprobe = default_nprobe
+        self.nprobe_by_bucket = {int(b): int(n) for b, n in (nprobe_by_bucket or dict()).items()}
+        self.latency_slo = latency_slo
+        self.min_nprobe = min_nprobe
+        self.percentile = percentile
+        self.scale = 1.0
+        self.latencies = deque(maxlen=window)
+        self.lock = Lock()
+
+    @staticmethod
+    def size_bucket(n_vectors: int) -> int:
+        return max(int(n_vectors), 1).bit_length()
+
+    def nprobe(self, n_vectors: int = None, nlist: int = None) -> int:
+        """
+        :param nlist: Centroids of the shard (nprobe is at most nlist)
+        :return: nprobe for a shard of n_vectors (scaled down under load)
+        """
+        base = self.default_nprobe
+        if n_vectors is not None and self.nprobe_by_bucket:
+            # Closest calibrated bucket (larger buckets on ties)
+            bucket = self.size_bucket(n_vectors)
+            nearest = min(self.nprobe_by_bucket, key=lambda b: (abs(b - bucket), -b))
+            base = self.nprobe_by_bucket[nearest]
+        nprobe = max(self.min_nprobe, int(round(base * self.scale)))
+        return min(nprobe, nlist) if nlist else nprobe
+
+    def observe(self, latency: float):
+        """ Records a search latency (seconds) and adjusts the scale if needed """
+        if self.latency_slo is None:
+            return
+        with self.lock:
+            self.latencies.append(latency)
+            if len(self.latencies) < max(self.latencies.maxlen // 4, 1):
+                return
+            observed = np.percentile(self.latencies, self.percentile)
+            max_nprobe = max([self.default_nprobe] + list(self.nprobe_by_bucket.values()))
+            if observed > self.latency_slo and max_nprobe * self.scale > self.min_nprobe:
+                self.scale *= 0.8
+            elif observed < 0.5 * self.latency_slo and self.scale < 1.0:
+                self.scale = min(1.0, self.scale * 1.25)
+            else:
+                return
+            self.latencies.clear()  # Judge the new scale on its own latencies
+
+    def calibrate(self, index_paths: List[Union[str, Path]], query_vectors: np.array,
+                  k: int = 10, recall_target: float = 0.95,
+                  shards_per_bucket: int = 3) -> Dict[int, int]:
+        """
+        Measures recall@k of each candidate nprobe on a sample of shards.
+        :param index_paths: Shards to sample (up to shards_per_bucket per size bucket)
+        :param query_vectors: Held-out queries shaped (n_queries, dim)
+        :param k: Neighbors compared per query
+        :param recall_target: Mean fraction of the true k-NN to retrieve
+        :return: Smallest nprobe meeting recall_target per size bucket
+            (the largest over a bucket's sampled shards)
+        """
+        query_vectors = np.ascontiguousarray(query_vectors, dtype=np.float32)
+        sampled = dict()
+        nprobe_by_bucket = dict()
+        for index_path in index_paths:
+            index = read_shard(index_path)
+            bucket = self.size_bucket(index.ntotal)
+            if sampled.get(bucket, 0) >= shards_per_bucket:
+                continue
+            sampled[bucket] = sampled.get(bucket, 0) + 1
+
+            nlist = faiss.extract_index_ivf(index).nlist
+            index.nprobe = nlist
+            _, truth = index.search(query_vectors, k)
+
+            chosen = nlist
+            for nprobe in self.candidates:
+                if nprobe >= nlist:
+                    break
+                index.nprobe = nprobe
+                _, found = index.search(query_vectors, k)
+                if self.recall(truth, found) >= recall_target:
+                    chosen = nprobe
+                    break
+            nprobe_by_bucket[bucket] = max(chosen, nprobe_by_bucket.get(bucket, 0))
+            print(f' * {Path(index_path).name}: {index.ntotal} vectors -> nprobe {chosen}')
+
+        self.nprobe_by_bucket.update(nprobe_by_bucket)
+        return nprobe_by_bucket
+
+    @staticmethod
+    def recall(truth: np.array, found: np.array) -> float:
+        """ :return: Mean fraction of each query's true neighbors found """
+        recalls = list()
+        for true_ids, found_ids in zip(truth, found):
+            true_ids = true_ids[true_ids >= 0]
+            if len(true_ids):
+                recalls.append(len(np.intersect1d(true_ids, found_ids)) / len(true_ids))
+        return float(np.mean(recalls)) if recalls else 1.0
+
+    def save(self, path: Union[str, Path]):
+        with open(str(path), 'w') as table:
+            json.dump({'default_nprobe': self.default_nprobe,
+                       'nprobe_by_bucket': {str(b): n for b, n
+                                            in sorted(self.nprobe_by_bucket.items())}},
+                      table, indent=1)
+
+    @classmethod
+    def load(cls, path: Union[str, Path], **kwargs) -> 'NprobeTuner':
+        """ :param kwargs: Override saved settings / set the latency controller """
+        with open(str(path), 'r') as table:
+            settings = json.load(table)
+        settings.update(kwargs)
+        return cls(**settings)
@@ -0,0 +1,110 @@
+from typing import Tuple
+
+import numpy as np
+import faiss
+
+from .base_indexer import read_shard
+
+__all__ = ['CoarseAssignment', 'load_quantizer', 'coarse_assign',
+           'range_search_preassigned', 'search_preassigned']
+
+
+# (centroid L2 distances, centroid ids), each shaped (n_queries, nprobe)
+CoarseAssignment = Tuple[np.array, np.array]
+
+
+def load_quantizer(index_path: str) -> faiss.Index:
+    """
+    Loads the coarse quantizer shared by every shard built from the same
+    pre-trained base index (see OnDiskIVFBuilder.load_base_idx).
+
+    :param index_path: Base index or any shard built from it
+    :return: Coarse quantizer (flat index of IVF centroids)
+    """
+    index = read_shard(index_path)
+    index_ivf = faiss.extract_index_ivf(index)
+
+    # Keep the quantizer alive after the IVF index is garbage collected
+    index_ivf.own_fields = False
+    return faiss.downcast_index(index_ivf.quantizer)
+
+
+def coarse_assign(quantizer: faiss.Index, query_vectors: np.array,
+                  nprobe: int) -> CoarseAssignment:
+    """
+    Finds the nprobe nearest centroids of each query once, so that every
+    shard can skip its own (identical) coarse quantizer search.
+
+    Note: nprobe is clamped to the number of centroids (faiss clamps it too,
+        and reads the assignment with a row stride of min(nprobe, nlist)).
+    """
+    query_vectors = np.ascontiguousarray(query_vectors, dtype=np.float32)
+    nprobe = min(nprobe, quantizer.ntotal)
+    coarse_dis, coarse_ids = quantizer.search(query_vectors, nprobe)
+    return coarse_dis, coarse_ids
+
+
+def range_search_preassigned(index: faiss.Index, query_vectors: np.array,
+                             radius: float, coarse: CoarseAssignment
+                             ) -> Tuple[np.array, np.array, np.array]:
+    """
+    IndexIVF.range_search() with precomputed centroids.
+        Falls back to IndexIVF.range_search() on faiss builds that do not
+        expose range_search_preassigned.
+
+    :return: lims, distances, labels (same layout as index.range_search)
+    """
+    coarse_dis, coarse_ids = coarse
+    x = np.ascontiguousarray(query_vectors, dtype=np.float32)
+    coarse_dis = np.ascontiguousarray(coarse_dis, dtype=np.float32)
+    coarse_ids = np.ascontiguousarray(coarse_ids, dtype=np.int64)
+
+    if not hasattr(index, 'range_search_preassigned'):
+        return index.range_search(x, radius)
+
+    try:
+        # faiss >= 1.7.3 numpy wrapper
+        return index.range_search_preassigned(x, radius, coarse_ids, coarse_dis)
+    except TypeError:
+        pass
+
+    # SWIG signature
+    n = x.shape[0]
+    res = faiss.RangeSearchResult(n)
+    index.range_search_preassigned(n, faiss.swig_ptr(x), radius,
+                                   faiss.swig_ptr(coarse_ids),
+                                   faiss.swig_ptr(coarse_dis), res)
+    lims = faiss.rev_swig_ptr(res.lims, n + 1).copy()
+    n_hits = int(lims[-1])
+    distances = faiss.rev_swig_ptr(res.distances, n_hits).copy()
+    labels = faiss.rev_swig_ptr(res.labels, n_hits).copy()
+    return lims, distances, labels
+
+
+def search_preassigned(index: faiss.Index, query_vectors: np.array, k: int,
+                       coarse: CoarseAssignment) -> Tuple[np.array, np.array]:
+    """
+    IndexIVF.search() with precomputed centroids.
+
+    :return: distances, labels shaped (n_queries, k)
+    """
+    coarse_dis, coarse_ids = coarse
+    x = np.ascontiguousarray(query_vectors, dtype=np.float32)
+    coarse_dis = np.ascontiguousarray(coarse_dis, dtype=np.float32)
+    coarse_ids = np.ascontiguousarray(coarse_ids, dtype=np.int64)
+
+    try:
+        # faiss >= 1.7.3 numpy wrapper
+        return index.search_preassigned(x, k, coarse_ids, coarse_dis)
+    except TypeError:
+        pass
+
+    # SWIG signature
+    n = x.shape[0]
+    distances = np.empty((n, k), dtype=np.float32)
+    labels = np.empty((n, k), dtype=np.int64)
+    index.search_preassigned(n, faiss.swig_ptr(x), k,
+                             faiss.swig_ptr(coarse_ids), faiss.swig_ptr(coarse_dis),
+                             faiss.swig_ptr(distances), faiss.swig_ptr(labels),
+                             False)
+    return distances, labels
@@ -0,0 +1,65 @@
+from contextlib import contextmanager
+from threading import Condition, Lock
+
+__all__ = ['ReadWriteLock']
+
+
+class ReadWriteLock(object):
+    """
+    Allows many concurrent readers or a single writer.
+        Writers take priority: once a writer is waiting, new readers wait
+        until it is done (prevents starving shard deployment under load).
+
+    Usage:
+        with rw_lock.read_locked():
+            ...
+        with rw_lock.write_locked():
+            ...
+    """
+
+    def __init__(self):
+        self._cond = Condition(Lock())
+        self._n_readers = 0
+        self._n_writers_waiting = 0
+        self._writing = False
+
+    def acquire_read(self):
+        with self._cond:
+            while self._writing or self._n_writers_waiting:
+                self._cond.wait()
+            self._n_readers += 1
+
+    def release_read(self):
+        with self._cond:
+            self._n_readers -= 1
+            if not self._n_readers:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        with self._cond:
+            self._n_writers_waiting += 1
+            while self._writing or self._n_readers:
+                self._cond.wait()
+            self._n_writers_waiting -= 1
+            self._writing = True
+
+    def release_write(self):
+        with self._cond:
+            self._writing = False
+            self._cond.notify_all()
+
+    @contextmanager
+    def read_locked(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write_locked(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
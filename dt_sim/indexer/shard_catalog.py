@@ -0,0 +1,92 @@
+import re
+import os.path as p
+from bisect import bisect_left, bisect_right
+from pathlib import Path
+from typing import Collection, Iterable, List, Tuple, Union
+
+__all__ = ['ShardCatalog', 'DateRange']
+
+
+# (first ISO date, last ISO date), both inclusive
+DateRange = Tuple[str, str]
+
+
+class ShardCatalog(object):
+    """
+    Shard names kept sorted by their ISO publication date (YYYY-MM-DD).
+        Date-range selection is a bisect, so the cost of picking shards
+        grows with the shards in the range, not with years of history.
+        Several shards may share a date (e.g. YYYY-MM-DD_zip_to_MMDD).
+
+    Note: Not thread-safe on its own; RangeShards only mutates its
+        catalog under the write lock.
+    """
+    date_seed = re.compile(r'\d{4}[-/]\d{2}[-/]\d{2}')
+
+    def __init__(self, shard_names: Iterable[str] = ()):
+        self.dates = list()     # Sorted
+        self.names = list()     # names[i] was published on dates[i]
+        for shard_name in shard_names:
+            self.add(shard_name)
+
+    @classmethod
+    def shard_date(cls, shard_name: Union[str, Path]) -> str:
+        """ :return: ISO date of a shard (file name first, then its dirs) """
+        shard_name = str(shard_name)
+        match = cls.date_seed.search(p.basename(shard_name)) or \
+            cls.date_seed.search(shard_name)
+        if match is None:
+            raise ValueError(f'Shard name does not contain an ISO date: {shard_name}')
+        return match.group().replace('/', '-')
+
+    def add(self, shard_name: str):
+        shard_date = self.shard_date(shard_name)
+        i = bisect_right(self.dates, shard_date)   # Same-day shards keep load order
+        self.dates.insert(i, shard_date)
+        self.names.insert(i, shard_name)
+
+    def remove(self, shard_name: str) -> bool:
+        """ :return: True if shard_name was in the catalog """
+        try:
+            i = self.names.index(shard_name)
+        except ValueError:
+            return False
+        del self.dates[i], self.names[i]
+        return True
+
+    def select(self, start: str = '0000-00-00', end: str = '9999-99-99') -> List[str]:
+        """ :return: Names of the shards dated start <= date <= end (oldest first) """
+        lo = bisect_left(self.dates, start)
+        hi = bisect_right(self.dates, end)
+        return self.names[lo:hi]
+
+    @classmethod
+    def date_ranges(cls, selected: List[str], skipped: Collection[str]) -> List[DateRange]:
+        """
+        Summarizes skipped shards as date ranges: one per run of skipped
+            shards that are adjacent in selected (oldest first).
+        :param selected: Shards returned by select() (sorted by date)
+        :param skipped: Subset of selected
+        """
+        runs = list()
+        for i, shard_name in enumerate(selected):
+            if shard_name not in skipped:
+                continue
+            if runs and runs[-1][1] == i - 1:
+                runs[-1][1] = i
+            else:
+                runs.append([i, i])
+        return [(cls.shard_date(selected[first]), cls.shard_date(selected[last]))
+                for first, last in runs]
+
+    def date_range(self) -> tuple:
+        """ :return: (oldest date, newest date), or (None, None) if empty """
+        if not self.dates:
+            return None, None
+        return self.dates[0], self.dates[-1]
+
+    def __contains__(self, shard_name: str) -> bool:
+        return shard_name in self.names
+
+    def __len__(self):
+        return len(self.names)
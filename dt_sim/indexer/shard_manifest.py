@@ -0,0 +1,201 @@
+import os
+import json
+import fcntl
+import base64
+import os.path as p
+from hashlib import sha1
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Union
+
+import numpy as np
+import faiss
+
+from .shard_catalog import ShardCatalog
+
+__all__ = ['ShardManifest', 'base_fingerprint', 'list_sizes']
+
+
+class ShardManifest(object):
+    """
+    Per-directory record of the on-disk shards written by OnDiskIVFBuilder.
+        Lets loaders discover shards and count vectors without opening
+        (or globbing for) every .index file.
+
+    Entries are keyed by .index file name:
+        {'date': 'YYYY-MM-DD', 'ntotal': int,
+         'index_bytes': int, 'ivfdata_bytes': int,
+         'index_sha1': str,             # Checksum of the .index file
+         'base_fingerprint': str,       # Coarse quantizer (see base_fingerprint)
+         'nlist': int,
+         'list_size_histogram': {'0': n_empty, '1': n, '2': n, '4': n, ...},
+         'nonempty_lists': str}         # base64 of np.packbits(list_size > 0)
+
+    Note: The .ivfdata file is not checksummed (it may hold terabytes);
+        entries whose file sizes no longer match are treated as stale.
+        Shards missing from the manifest are still deployed (loaders glob
+        for them); the manifest only spares them from being opened.
+
+    Note: Writers hold an exclusive flock on a sibling .lock file while they
+        re-read, modify and save the manifest (concurrent builders).
+    """
+    filename = 'shards.manifest.json'
+
+    def __init__(self, shard_dir: Union[str, Path]):
+        self.shard_dir = p.abspath(str(shard_dir))
+        self.path = p.join(self.shard_dir, self.filename)
+        self.lock_path = self.path + '.lock'
+        self.entries = self.load()
+
+    @classmethod
+    def exists(cls, shard_dir: Union[str, Path]) -> bool:
+        return p.isfile(p.join(str(shard_dir), cls.filename))
+
+    @classmethod
+    def for_index(cls, index_path: Union[str, Path]) -> 'ShardManifest':
+        return cls(p.dirname(p.abspath(str(index_path))))
+
+    def load(self) -> Dict[str, dict]:
+        if not p.isfile(self.path):
+            return dict()
+        with open(self.path, 'r') as manifest:
+            return json.load(manifest)
+
+    def save(self):
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as manifest:
+            json.dump(self.entries, manifest, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    @contextmanager
+    def locked(self):
+        """ Re-reads the manifest under an exclusive lock (for read-modify-save) """
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self.entries = self.load()
+                yield self.entries
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def record(self, index_path: Union[str, Path], index: faiss.Index = None) -> dict:
+        """
+        Describes a shard and saves it to the manifest.
+        :param index_path: /full/path/to/shard.index (in self.shard_dir)
+        :param index: The shard, if already in memory (otherwise it is read)
+        """
+        entry = self.describe(index_path, index)
+        with self.locked() as entries:
+            entries[p.basename(str(index_path))] = entry
+            self.save()
+        return entry
+
+    def discard(self, index_path: Union[str, Path]):
+        with self.locked() as entries:
+            if entries.pop(p.basename(str(index_path)), None) is not None:
+                self.save()
+
+    def get(self, index_path: Union[str, Path]) -> Union[dict, None]:
+        """ :return: The shard's entry, or None if missing or stale """
+        index_path = str(index_path)
+        entry = self.entries.get(p.basename(index_path))
+        if entry is None:
+            return None
+        try:
+            if os.stat(index_path).st_size != entry['index_bytes']:
+                return None
+            if entry['ivfdata_bytes'] and \
+                    os.stat(ivfdata_path(index_path)).st_size != entry['ivfdata_bytes']:
+                return None     # In-memory shards have no .ivfdata
+        except FileNotFoundError:
+            return None
+        return entry
+
+    def index_paths(self) -> List[Path]:
+        """ :return: Recorded shards that still exist (sorted by name) """
+        return [Path(self.shard_dir, filename) for filename in sorted(self.entries)
+                if p.isfile(p.join(self.shard_dir, filename))]
+
+    def rebuild(self) -> int:
+        """
+        (Re)records every .index file in self.shard_dir (reads each once).
+        :return: Number of shards recorded
+        """
+        entries = dict()
+        for index_path in sorted(Path(self.shard_dir).glob('*.index')):
+            try:
+                entries[index_path.name] = self.describe(index_path)
+            except (RuntimeError, ValueError) as e:
+                print(f'Unable to record index: {index_path} ({e})')
+        with self.locked():
+            self.entries = entries
+            self.save()
+        return len(self.entries)
+
+    @staticmethod
+    def describe(index_path: Union[str, Path], index: faiss.Index = None) -> dict:
+        index_path = p.abspath(str(index_path))
+        if index is None:
+            try:
+                index = faiss.read_index(index_path)
+            except RuntimeError:
+                index = faiss.read_index(index_path, faiss.IO_FLAG_ONDISK_SAME_DIR)
+        index_ivf = faiss.extract_index_ivf(index)
+        sizes = list_sizes(index_ivf)
+
+        # Bins: empty, then powers of two (1, 2-3, 4-7, ...)
+        bins = np.zeros(sizes.shape, dtype=np.int64)
+        nonempty = sizes > 0
+        bins[nonempty] = 2 ** np.floor(np.log2(sizes[nonempty])).astype(np.int64)
+        bin_edges, counts = np.unique(bins, return_counts=True)
+
+        return {
+            'date': ShardCatalog.shard_date(index_path),
+            'ntotal': int(index.ntotal),
+            'index_bytes': os.stat(index_path).st_size,
+            'ivfdata_bytes': os.stat(ivfdata_path(index_path)).st_size
+            if p.isfile(ivfdata_path(index_path)) else 0,
+            'index_sha1': file_sha1(index_path),
+            'base_fingerprint': base_fingerprint(index_ivf),
+            'nlist': int(index_ivf.nlist),
+            'list_size_histogram': {str(b): int(c) for b, c in zip(bin_edges, counts)},
+            'nonempty_lists': base64.b64encode(np.packbits(nonempty)).decode('ascii'),
+        }
+
+    @staticmethod
+    def nonempty_lists(entry: dict) -> np.array:
+        """ :return: Bool mask (nlist,) of the shard's non-empty inverted lists """
+        packed = np.frombuffer(base64.b64decode(entry['nonempty_lists']), dtype=np.uint8)
+        return np.unpackbits(packed)[:entry['nlist']].astype(bool)
+
+
+def ivfdata_path(index_path: str) -> str:
+    return str(index_path).replace('.index', '.ivfdata')
+
+
+def file_sha1(path: str, chunk_size: int = 2**20) -> str:
+    digest = sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def list_sizes(index_ivf: faiss.Index) -> np.array:
+    """ :return: Number of vectors in each inverted list, shaped (nlist,) """
+    invlists = index_ivf.invlists
+    return np.array([invlists.list_size(i) for i in range(index_ivf.nlist)],
+                    dtype=np.int64)
+
+
+def base_fingerprint(index: faiss.Index) -> str:
+    """
+    Digest of an IVF index's coarse quantizer (its centroids and metric).
+        Shards built from the same base index share a fingerprint.
+    """
+    index_ivf = faiss.extract_index_ivf(index)
+    quantizer = faiss.downcast_index(index_ivf.quantizer)
+    centroids = quantizer.reconstruct_n(0, quantizer.ntotal)
+    digest = sha1(np.ascontiguousarray(centroids, dtype=np.float32).tobytes())
+    digest.update(f'{index_ivf.nlist},{index_ivf.d},{index_ivf.metric_type}'.encode())
+    return digest.hexdigest()
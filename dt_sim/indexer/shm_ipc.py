@@ -0,0 +1,109 @@
+import os
+import mmap
+import tempfile
+from uuid import uuid4
+from itertools import count
+from typing import List, Union
+
+import numpy as np
+
+__all__ = ['SharedArrays', 'share_arrays', 'load_arrays', 'SHM_MIN_BYTES']
+
+
+# Smaller payloads are cheaper to pickle through the pipe
+SHM_MIN_BYTES = 2**16
+
+# tmpfs: segments never touch a disk
+SHM_DIR = '/dev/shm' if os.access('/dev/shm', os.W_OK) else tempfile.gettempdir()
+
+_segment_ids = count()
+
+
+class SharedArrays(object):
+    """
+    Descriptor of numpy arrays held in a shared-memory segment.
+        Only the descriptor (a file name and dtypes/shapes/offsets) is
+        pickled between processes; readers map the segment and get
+        read-only views of the arrays without copying them.
+
+    Note: The writer creates the segment. Whoever reads it last unlinks it
+        (mapped views remain valid after unlinking).
+    """
+    __slots__ = ('path', 'specs')
+
+    def __init__(self, path: str, specs: list):
+        self.path = path
+        self.specs = specs  # (dtype str, shape, offset) or None per array
+
+    def __getstate__(self):
+        return self.path, self.specs
+
+    def __setstate__(self, state):
+        self.path, self.specs = state
+
+    def load(self) -> List[Union[np.array, None]]:
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            buffer = mmap.mmap(fd, os.fstat(fd).st_size, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        return [None if spec is None else
+                np.ndarray(spec[1], dtype=np.dtype(spec[0]), buffer=buffer, offset=spec[2])
+                for spec in self.specs]
+
+    def unlink(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def share_arrays(arrays: List[Union[np.array, None]], min_bytes: int = SHM_MIN_BYTES
+                 ) -> Union[SharedArrays, List[Union[np.array, None]]]:
+    """
+    Writes arrays to a new shared-memory segment.
+    :param arrays: Arrays to share (None entries are kept as None)
+    :param min_bytes: Smaller payloads are returned as is (sent pickled)
+    :return: SharedArrays descriptor (or the arrays themselves)
+    """
+    arrays = [None if a is None else np.ascontiguousarray(a) for a in arrays]
+    if sum(a.nbytes for a in arrays if a is not None) < min_bytes:
+        return arrays
+
+    specs = list()
+    offset = 0
+    for a in arrays:
+        if a is None:
+            specs.append(None)
+            continue
+        offset += -offset % 64  # Cache-line aligned
+        specs.append((a.dtype.str, a.shape, offset))
+        offset += a.nbytes
+
+    path = os.path.join(SHM_DIR, f'dt_sim_{os.getpid()}_{next(_segment_ids)}_{uuid4().hex[:8]}')
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        os.ftruncate(fd, max(offset, 1))
+        for a, spec in zip(arrays, specs):
+            if spec is not None and a.nbytes:
+                os.pwrite(fd, memoryview(a.reshape(-1)).cast('B'), spec[2])
+    except BaseException:
+        os.unlink(path)
+        raise
+    finally:
+        os.close(fd)
+    return SharedArrays(path, specs)
+
+
+def load_arrays(payload: Union[SharedArrays, list], unlink: bool = False
+                ) -> List[Union[np.array, None]]:
+    """
+    Inverse of share_arrays (works for both kinds of payload).
+    :param unlink: Remove the segment once mapped (last reader only)
+    """
+    if not isinstance(payload, SharedArrays):
+        return list(payload)
+    arrays = payload.load()
+    if unlink:
+        payload.unlink()
+    return arrays
@@ -0,0 +1,64 @@
+from typing import List, Set, Tuple
+
+import faiss
+
+__all__ = ['promote_to_ram', 'ram_resident', 'plan_hot_shards']
+
+
+# (shard name, ISO date, bytes in RAM, recent query count)
+ShardUsage = Tuple[str, str, int, float]
+
+
+def promote_to_ram(index: faiss.Index) -> int:
+    """
+    Copies an on-disk index's inverted lists into ArrayInvertedLists
+        (searches no longer touch the .ivfdata file).
+        The on-disk lists are released; re-read the index to demote it.
+
+    :return: Bytes of codes and ids copied into memory
+    """
+    index_ivf = faiss.extract_index_ivf(index)
+    disk_lists = index_ivf.invlists
+    if ram_resident(index):
+        return 0
+
+    ram_lists = faiss.ArrayInvertedLists(index_ivf.nlist, index_ivf.code_size)
+    n_bytes = 0
+    for list_no in range(index_ivf.nlist):
+        list_size = disk_lists.list_size(list_no)
+        if list_size:
+            ram_lists.add_entries(list_no, list_size,
+                                  disk_lists.get_ids(list_no),
+                                  disk_lists.get_codes(list_no))
+            n_bytes += list_size * (index_ivf.code_size + 8)
+
+    index_ivf.replace_invlists(ram_lists, True)
+    ram_lists.this.disown()     # Owned by index_ivf now
+    return n_bytes
+
+
+def ram_resident(index: faiss.Index) -> bool:
+    invlists = faiss.extract_index_ivf(index).invlists
+    return isinstance(faiss.downcast_InvertedLists(invlists), faiss.ArrayInvertedLists)
+
+
+def plan_hot_shards(shards: List[ShardUsage], hot_since: str, max_bytes: int) -> Set[str]:
+    """
+    Picks the shards to hold in RAM: shards dated hot_since or later
+        (newest first), then the most queried older shards, until
+        max_bytes is spent.
+
+    :return: Names of the shards that should be RAM-resident
+    """
+    recent = sorted((s for s in shards if s[1] >= hot_since),
+                    key=lambda s: s[1], reverse=True)
+    frequent = sorted((s for s in shards if s[1] < hot_since and s[3] > 0),
+                      key=lambda s: s[3], reverse=True)
+
+    hot = set()
+    n_bytes = 0
+    for shard_name, _, shard_bytes, _ in recent + frequent:
+        if n_bytes + shard_bytes <= max_bytes:
+            hot.add(shard_name)
+            n_bytes += shard_bytes
+    return hot
@@ -0,0 +1,103 @@
+import os
+from typing import List, Tuple
+
+import numpy as np
+import faiss
+
+__all__ = ['list_extents', 'advise_willneed', 'warm_lists', 'prefetch_probed']
+
+
+# (byte offset, byte length) of an inverted list in its .ivfdata file
+Extent = Tuple[int, int]
+
+
+def list_extents(index: faiss.Index, list_ids: List[int] = None) -> List[Extent]:
+    """
+    Locates inverted lists (codes and ids) in an on-disk index's .ivfdata file.
+    :param list_ids: Lists to locate, in priority order (Default: all lists)
+    :return: One extent per non-empty list (none for in-memory indexes)
+    """
+    index_ivf = faiss.extract_index_ivf(index)
+    invlists = faiss.downcast_InvertedLists(index_ivf.invlists)
+    if not isinstance(invlists, faiss.OnDiskInvertedLists):
+        return list()
+
+    if list_ids is None:
+        list_ids = range(index_ivf.nlist)
+    base = int(invlists.ptr)
+    id_size = np.dtype(np.int64).itemsize
+    extents = list()
+    for list_no in list_ids:
+        list_size = invlists.list_size(int(list_no))
+        if not list_size:
+            continue
+        start = int(invlists.get_codes(int(list_no))) - base
+        end = int(invlists.get_ids(int(list_no))) - base + list_size * id_size
+        extents.append((start, end - start))
+    return extents
+
+
+def advise_willneed(path: str, extents: List[Extent], max_bytes: int = None,
+                    max_gap: int = 2**16) -> int:
+    """
+    Asks the kernel to read file regions into the page cache (readahead).
+        Returns immediately; the reads happen in the background and are
+        shared by every process that maps the file.
+
+    :param extents: Regions in priority order (cut off at max_bytes)
+    :param max_gap: Regions closer than this are advised as one
+    :return: Number of bytes advised
+    """
+    if not hasattr(os, 'posix_fadvise') or not extents:
+        return 0
+
+    budget = list()
+    n_bytes = 0
+    for offset, length in extents:
+        if max_bytes is not None and n_bytes + length > max_bytes:
+            continue
+        budget.append((offset, length))
+        n_bytes += length
+
+    # Coalesce nearby regions (fewer, larger reads)
+    merged = list()
+    for offset, length in sorted(budget):
+        if merged and offset <= merged[-1][0] + merged[-1][1] + max_gap:
+            last_offset, last_length = merged[-1]
+            merged[-1] = (last_offset, max(last_length, offset + length - last_offset))
+        else:
+            merged.append((offset, length))
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        for offset, length in merged:
+            os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+    return n_bytes
+
+
+def warm_lists(index: faiss.Index, list_ids: List[int] = None,
+               max_bytes: int = None) -> int:
+    """
+    Pulls an on-disk index's inverted lists into the page cache.
+    :param list_ids: Lists to warm, in priority order (Default: all lists)
+    :return: Number of bytes advised (0 for in-memory indexes)
+    """
+    extents = list_extents(index, list_ids)
+    if not extents:
+        return 0
+    invlists = faiss.downcast_InvertedLists(faiss.extract_index_ivf(index).invlists)
+    return advise_willneed(invlists.filename, extents, max_bytes)
+
+
+def prefetch_probed(index: faiss.Index, coarse_ids: np.array) -> int:
+    """
+    Issues readahead for every inverted list a search is about to probe,
+        before the distance scan faults them in one at a time. The kernel
+        reads the lists concurrently (deep I/O queue instead of depth 1).
+    :param coarse_ids: Probed list ids shaped (n_queries, nprobe) (-1: skipped)
+    :return: Number of bytes advised (0 for in-memory indexes)
+    """
+    list_ids = np.unique(coarse_ids[coarse_ids >= 0])
+    return warm_lists(index, list_ids) if len(list_ids) else 0
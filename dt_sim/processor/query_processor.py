@@ -2,7 +2,6 @@ import os
 import sys
 import traceback
 from time import time
-from pickle import dumps as phash
 from typing import Dict, List, Tuple, Union
 
 os.environ['OMP_WAIT_POLICY'] = 'PASSIVE'
@@ -31,14 +30,21 @@ class QueryProcessor(BaseProcessor):
         self.vectorizer = query_vectorizer
         self.n_queries = 0
 
+        # Shards evicted by the indexer's retention window
+        on_evict = getattr(self.indexer, 'on_evict', None)
+        if on_evict is not None:
+            on_evict.append(lambda shard_names: self.query_corpus.cache_clear())
+
     @faiss_cache(1)
     def query_corpus(self, query_str: str, k: int = 5, radius: float = 0.65,
                      start: str = '0000-00-00', end: str = '9999-99-99',
-                     rerank_by_doc: bool = True, verbose: bool = True
-                     ) -> SortedScoresIDs:
+                     rerank_by_doc: bool = True, verbose: bool = True,
+                     mode: str = 'range', nprobe: int = None) -> SortedScoresIDs:
         """
         Vectorize query -> Search faiss index handler -> Format doc payload
         Expects to receive only one query per call.
+            Shard workers reduce their hits to their k best docs (by_doc),
+            so formatting only sees the hits of candidate docs.
         :param query_str: Query to vectorize
         :param k: Number of nearest neighboring documents to return
         :param radius: Maximum L2 distance between the query and a result
@@ -47,6 +53,8 @@ class QueryProcessor(BaseProcessor):
             (Requires shards with names containing an ISO-date-string)
         :param end: Limit date-range search up to this YYYY-MM-DD
         :param rerank_by_doc: Returns all hits within a document (score = best)
+        :param mode: 'range' or 'knn' (bounded work per shard, see RangeShards)
+        :param nprobe: Centroids visited per shard (Default: the indexer's choice)
         :return: k sorted document hits
         """
         # Vectorize
@@ -57,15 +65,12 @@ class QueryProcessor(BaseProcessor):
         t_s = time()
         scores, faiss_ids = self.indexer.search(query_vector,
                                                 k=k, radius=radius,
-                                                start=start, end=end)
+                                                start=start, end=end,
+                                                by_doc=True, mode=mode, nprobe=nprobe)
 
         # Aggregate hits into docs -> rerank (soon) -> format
         t_p = time()
-        doc_hits = self.aggregate_docs(scores, faiss_ids)
-        if rerank_by_doc:
-            similar_docs = self.format_payload_docs(doc_hits)
-        else:
-            similar_docs = self.format_payload_singles(doc_hits)
+        similar_docs = self.format_results(scores, faiss_ids, k, rerank_by_doc)
 
         t_r = time()
         self.n_queries += 1
@@ -75,6 +80,99 @@ class QueryProcessor(BaseProcessor):
                   f'\n * Index searched in ----- {t_p - t_s:0.4f}s'
                   f'\n * Payload formatted in -- {t_r - t_p:0.4f}s')
 
+        return similar_docs
+
+    def batch_query_corpus(self, queries: List[str], k: int = 5, radius: float = 0.65,
+                           start: str = '0000-00-00', end: str = '9999-99-99',
+                           rerank_by_doc: bool = True, verbose: bool = True,
+                           mode: str = 'range', nprobe: int = None
+                           ) -> List[SortedScoresIDs]:
+        """
+        Vectorize all queries -> Search every shard once -> Format doc payloads
+        :param queries: Queries to vectorize (one TF Serving request)
+        :param k: Number of nearest neighboring documents to return per query
+        :param radius: Maximum L2 distance between a query and a result
+        :param start: Search shards corresponding to this date and beyond
+            (Requires shards with names containing an ISO-date-string)
+        :param end: Limit date-range search up to this YYYY-MM-DD
+        :param rerank_by_doc: Returns all hits within a document (score = best)
+        :param verbose: Prints time spent on each step
+        :param mode: 'range' or 'knn' (bounded work per shard, see RangeShards)
+        :param nprobe: Centroids visited per shard (Default: the indexer's choice)
+        :return: k sorted document hits for each query (in query order)
+        """
+        # Vectorize
+        t_v = time()
+        query_vectors = self.vectorize_batch(queries)
+
+        # Search
+        t_s = time()
+        batch_results = self.indexer.batch_search(query_vectors,
+                                                  k=k, radius=radius,
+                                                  start=start, end=end,
+                                                  by_doc=True, mode=mode, nprobe=nprobe)
+
+        # Aggregate hits into docs -> format
+        t_p = time()
+        payloads = [self.format_results(scores, faiss_ids, k, rerank_by_doc)
+                    for scores, faiss_ids in batch_results]
+
+        t_r = time()
+        self.n_queries += len(queries)
+        if verbose:
+            print(f'\n Q: {self.n_queries} (batch of {len(queries)})'
+                  f'\n * Queries vectorized in --- {t_s - t_v:0.4f}s'
+                  f'\n * Index searched in ------- {t_p - t_s:0.4f}s'
+                  f'\n * Payloads formatted in --- {t_r - t_p:0.4f}s')
+
+        return payloads
+
+    def search_vectors(self, query_vectors: np.array, k: int = 5, radius: float = 0.65,
+                       start: str = '0000-00-00', end: str = '9999-99-99',
+                       rerank_by_doc: bool = True, mode: str = 'range',
+                       nprobe: int = None) -> List[SortedScoresIDs]:
+        """
+        Search faiss index handler -> Format doc payloads (no vectorization)
+            Used by services that vectorize queries themselves.
+        :param query_vectors: Query embeddings shaped (n_queries, dim)
+        :return: k sorted document hits for each query (in query order)
+        """
+        batch_results = self.indexer.batch_search(query_vectors,
+                                                  k=k, radius=radius,
+                                                  start=start, end=end,
+                                                  by_doc=True, mode=mode, nprobe=nprobe)
+        return [self.format_results(scores, faiss_ids, k, rerank_by_doc)
+                for scores, faiss_ids in batch_results]
+
+    def partial_search_vectors(self, query_vectors: np.array, deadline: float,
+                               k: int = 5, radius: float = 0.65,
+                               start: str = '0000-00-00', end: str = '9999-99-99',
+                               rerank_by_doc: bool = True, mode: str = 'range',
+                               nprobe: int = None
+                               ) -> Tuple[List[SortedScoresIDs], List[Tuple[str, str]]]:
+        """
+        search_vectors() within a deadline (see RangeShards.partial_search)
+        :param deadline: Seconds to wait for shards
+        :return: k sorted document hits for each query (in query order),
+            (start, end) date ranges that were not searched
+        """
+        batch_results, skipped = self.indexer.partial_search(query_vectors,
+                                                             k=k, radius=radius,
+                                                             start=start, end=end,
+                                                             by_doc=True, mode=mode,
+                                                             nprobe=nprobe,
+                                                             deadline=deadline)
+        return [self.format_results(scores, faiss_ids, k, rerank_by_doc)
+                for scores, faiss_ids in batch_results], skipped
+
+    def format_results(self, scores: DiffScores, faiss_ids: VectorIDs, k: int,
+                       rerank_by_doc: bool = True) -> SortedScoresIDs:
+        """ Aggregate hits into docs -> format k best docs """
+        doc_hits = self.aggregate_docs(scores, faiss_ids, k=k)
+        if rerank_by_doc:
+            similar_docs = self.format_payload_docs(doc_hits)
+        else:
+            similar_docs = self.format_payload_singles(doc_hits)
         return similar_docs[:k]
 
     def vectorize(self, query: Union[str, List[str]]) -> QueryReturn:
@@ -94,48 +192,64 @@ class QueryProcessor(BaseProcessor):
             query_vector = np.array(query_vector, dtype=np.float32)
         return query_vector
 
+    def vectorize_batch(self, queries: List[str]) -> QueryReturn:
+        """
+        Vectorizes every query with one request to the DockerVectorizer.
+        :param queries: Texts to vectorize
+        :return: Query embeddings shaped (n_queries, dim)
+        """
+        query_vectors = self.vectorizer.make_vector_batch(queries)
+        return np.array(query_vectors, dtype=np.float32)
+
     @staticmethod
     def aggregate_docs(scores: DiffScores, faiss_ids: VectorIDs,
-                       require_unique_score: bool = True) -> DocPayload:
+                       require_unique_score: bool = True, k: int = None,
+                       min_diff: float = 0.01) -> DocPayload:
         """
         Collects outputs from faiss search into document entities.
+            Hits are grouped with NumPy (doc_id = faiss_id // 10000) and
+            only the returned docs are converted to strings.
         :param scores: Faiss query/hit vector L2 distances
         :param faiss_ids: Faiss vector ids
         :param require_unique_score: Discard docs with duplicate sum(scores)
+        :param k: Only return the k best docs (default: all docs)
+        :param min_diff: Diff scores are floored at this value
         :return: Dict of docs (key: document id, val: doc with sentence hits)
+            ordered by each doc's first hit in the search results
         """
+        diffs = np.maximum(np.asarray(scores[0], dtype=np.float32), np.float32(min_diff))
+        ids = np.asarray(faiss_ids[0], dtype=np.int64)
+        positions = np.flatnonzero(ids > 0)
+        if not len(positions):
+            return dict()
+        diffs, ids = diffs[positions], ids[positions]
+        doc_ids = ids // 10000
 
-        def min_diff_cutoff(diff_score, cutoff=0.01) -> str:
-            return str(max(diff_score, cutoff))
-
-        def sort_score_ids(sc_ids: rawScoreIDs) -> rawScoreIDs:
-            # Checks if already sorted
-            if not all(sc_ids[i][0] <= sc_ids[i+1][0] for i in range(len(sc_ids)-1)):
-                sc_ids.sort(key=lambda sc_id_tup: sc_id_tup[0])
-
-            return sc_ids
-
-        docs = dict()
-        for score, faiss_id in zip(scores[0], faiss_ids[0]):
-            if faiss_id > 0:
-                doc_id, sent_id = divmod(faiss_id, 10000)
-                doc_id = str(doc_id)
-                if doc_id not in docs:
-                    docs[doc_id] = list()
-                docs[doc_id].append((min_diff_cutoff(score), str(faiss_id)))
-
-        if require_unique_score:
-            doc_hits = dict()
-            unique_doc_scores = set()
-            for doc_id, score_ids in docs.items():
-                doc_score_hash = phash(sorted([sc_id[0] for sc_id in score_ids]))
-                if doc_score_hash not in unique_doc_scores:
-                    unique_doc_scores.add(doc_score_hash)
-                    doc_hits[doc_id] = sort_score_ids(score_ids)
-        else:
-            doc_hits = dict()
-            for doc_id, score_ids in docs.items():
-                doc_hits[doc_id] = sort_score_ids(score_ids)
+        # Group hits by doc (hits sorted by score within each doc)
+        order = np.lexsort((positions, diffs, doc_ids))
+        diffs, ids, doc_ids, positions = \
+            diffs[order], ids[order], doc_ids[order], positions[order]
+        starts = np.flatnonzero(np.r_[True, doc_ids[1:] != doc_ids[:-1]])
+        ends = np.r_[starts[1:], len(doc_ids)]
+
+        # Rank docs by their first appearance in the search results
+        first_hit = np.minimum.reduceat(positions, starts)
+        doc_rank = np.argsort(first_hit, kind='stable')
+
+        doc_hits = dict()
+        unique_doc_scores = set()
+        for g in doc_rank:
+            if k is not None and len(doc_hits) >= k:
+                break
+            doc_diffs = diffs[starts[g]:ends[g]]
+            if require_unique_score:
+                doc_score_hash = hash(doc_diffs.tobytes())
+                if doc_score_hash in unique_doc_scores:
+                    continue
+                unique_doc_scores.add(doc_score_hash)
+            doc_hits[str(doc_ids[starts[g]])] = \
+                [(str(diff), str(faiss_id)) for diff, faiss_id
+                 in zip(doc_diffs, ids[starts[g]:ends[g]])]
 
         return doc_hits
 
@@ -196,6 +310,7 @@ class QueryProcessor(BaseProcessor):
         if os.path.isfile(shard_path) and shard_path.endswith('.index'):
             try:
                 self.indexer.add_shard(shard_path)
+                self.query_corpus.cache_clear()     # Cached results miss the shard
             except NameError as e:
                 exc_type, exc_val, exc_trace = sys.exc_info()
                 lines = traceback.format_exception(exc_type, exc_val, exc_trace)
@@ -209,6 +324,30 @@ class QueryProcessor(BaseProcessor):
         else:
             print(f'Error: Unexpected input: {shard_path}')
 
+    def remove_shard(self, shard_path: str) -> bool:
+        """
+         Takes a deployed shard offline (its files are left on disk).
+        :param shard_path: /full/path/to/shard.index
+        :return: True if the shard was deployed
+        """
+        removed = self.indexer.remove_shard(shard_path)
+        if removed:
+            self.query_corpus.cache_clear()     # May hold the shard's hits
+        else:
+            print(f'Error: Shard is not deployed: {shard_path}')
+        return removed
+
+    def cache_info(self) -> dict:
+        """ Hit/miss/eviction counters of the query and shard caches """
+        info = {'query_corpus': self.query_corpus.cache_info()}
+        shard_cache = getattr(self.indexer, 'shard_cache', None)
+        if shard_cache is not None:
+            info['shards'] = shard_cache.stats()
+        embedding_cache = getattr(self.vectorizer, 'cache', None)
+        if embedding_cache is not None:
+            info['embeddings'] = embedding_cache.stats()
+        return info
+
     def print_shards(self):
         n_shards = len(self.indexer.paths_to_shards)
         print(f'Faiss Index Shards Deployed: {n_shards}')
@@ -0,0 +1,58 @@
+from typing import List
+
+import aiohttp
+import numpy as np
+
+from .sentence_vectorizer import DockerVectorizer
+
+__all__ = ['AsyncDockerVectorizer']
+
+
+#### Non-blocking Query Vectorization ####
+class AsyncDockerVectorizer(DockerVectorizer):
+    """
+    DockerVectorizer for asyncio services.
+        TF Serving requests are awaited on the event loop (no thread is
+        blocked while the model runs). Shares the embedding cache and
+        request formats of DockerVectorizer.
+    Note: Call (and await) from a running event loop.
+    """
+    def __init__(self, *args, pool_size: int = 32, **kwargs):
+        super().__init__(*args, pool_size=pool_size, **kwargs)
+        self.pool_size = pool_size
+        self.client = None  # Bound to the event loop on first use
+
+    async def make_vectors_async(self, query: str) -> np.array:
+        """ Takes one query """
+        return await self.make_vector_batch_async([query])
+
+    async def make_vector_batch_async(self, queries: List[str]) -> np.array:
+        """
+        Takes many queries (uncached ones are vectorized with a single request)
+        :return: Embeddings shaped (n_queries, dim)
+        """
+        queries = [str(query) for query in queries]
+        embeddings, missing = self.check_cache(queries)
+        if missing:
+            new_embeddings = await self.post_predict_async([queries[i] for i in missing])
+            self.fill_cache(queries, embeddings, missing, new_embeddings)
+
+        return np.vstack(embeddings)
+
+    async def post_predict_async(self, sentences: List[str]) -> list:
+        if self.client is None:
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            self.client = aiohttp.ClientSession(connector=connector)
+
+        async with self.client.post(self.url, data=self.make_payload(sentences),
+                                    headers={'Content-Type': 'application/json'}
+                                    ) as response:
+            response.raise_for_status()
+            response_json = await response.json()
+
+        return self.parse_predictions(response_json)
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.close()
+            self.client = None
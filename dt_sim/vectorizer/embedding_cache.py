@@ -0,0 +1,122 @@
+import os
+import os.path as p
+import atexit
+import unicodedata
+from threading import Lock, Thread
+from pathlib import Path
+from typing import List, Union
+
+import numpy as np
+
+from dt_sim.indexer.faiss_cache import LRUCache
+
+__all__ = ['EmbeddingCache']
+
+
+class EmbeddingCache(object):
+    """
+    Thread-safe LRU of query text -> float32 embedding.
+        Keys are normalized (unicode NFC, collapsed whitespace), so
+        trivially different spellings of a query share one embedding.
+        Optionally persisted to a .npz file to survive restarts.
+    """
+
+    def __init__(self, limit: int = 4096, path: Union[str, Path] = None,
+                 save_every: int = 256):
+        """
+        :param limit: Number of embeddings to hold
+        :param path: Optional /path/to/query_embeddings.npz
+            (loaded now, saved every save_every new embeddings and at exit)
+        :param save_every: New embeddings between saves (0: only at exit)
+            Periodic saves run on a background thread, not in put()
+        """
+        self.cache = LRUCache(limit)
+        self.path = p.abspath(path) if path else None
+        self.save_every = save_every
+        self.n_unsaved = 0
+        self.saving = False
+        self.unsaved_lock = Lock()
+        self.save_lock = Lock()
+
+        if self.path:
+            self.load()
+            atexit.register(self.save)
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return ' '.join(unicodedata.normalize('NFC', str(text)).split())
+
+    def get(self, text: str) -> np.array:
+        return self.cache.get(self.normalize(text))
+
+    def put(self, text: str, embedding: np.array):
+        embedding = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        self.cache.put(self.normalize(text), embedding)
+        if self.path and self.save_every:
+            with self.unsaved_lock:
+                self.n_unsaved += 1
+                due = self.n_unsaved >= self.save_every and not self.saving
+                if due:
+                    self.n_unsaved, self.saving = 0, True
+            if due:
+                Thread(target=self.save_in_background, daemon=True).start()
+
+    def get_many(self, texts: List[str]) -> List[np.array]:
+        """ :return: Cached embedding (or None) for each text """
+        return [self.get(text) for text in texts]
+
+    def stats(self) -> dict:
+        return self.cache.stats()
+
+    def embeddings(self) -> np.array:
+        """ :return: Every cached embedding shaped (n, dim), or None if empty """
+        items = self.cache.items()
+        if not items:
+            return None
+        return np.vstack([embedding for _, embedding in items])
+
+    def load(self):
+        if not p.isfile(self.path):
+            return
+        try:
+            with np.load(self.path) as npz:
+                texts, embeddings = npz['texts'], npz['embeddings']
+        except (OSError, KeyError, ValueError) as e:
+            print(f'Could not load query embeddings: {self.path} ({e})')
+            return
+        for text, embedding in zip(texts, embeddings):
+            self.cache.put(str(text), embedding)
+        print(f'Loaded {len(texts)} cached query embeddings from {self.path}')
+
+    def save(self):
+        """
+        Atomically writes the cache to self.path.
+            Each process writes its own temporary file (pre-forked servers
+            share one path); the last replace wins.
+        """
+        if not self.path:
+            return
+        with self.save_lock:
+            with self.unsaved_lock:
+                self.n_unsaved = 0
+            items = self.cache.items()
+            if not items:
+                return
+            texts = np.array([text for text, _ in items])
+            embeddings = np.vstack([embedding for _, embedding in items])
+
+            tmp_path = f'{self.path}.{os.getpid()}.tmp.npz'
+            try:
+                np.savez(tmp_path, texts=texts, embeddings=embeddings)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                print(f'Could not save query embeddings: {self.path} ({e})')
+                if p.isfile(tmp_path):
+                    os.remove(tmp_path)
+
+    def save_in_background(self):
+        try:
+            self.save()
+        finally:
+            with self.unsaved_lock:
+                self.saving = False
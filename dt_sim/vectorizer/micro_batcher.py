@@ -0,0 +1,73 @@
+from time import monotonic
+from queue import Queue, Empty
+from threading import Thread
+from concurrent.futures import Future
+from typing import Callable, List
+
+__all__ = ['MicroBatcher']
+
+
+class MicroBatcher(object):
+    """
+    Combines sentences submitted by concurrent threads into one call.
+        The first waiting request opens a batch. The batch closes after
+        max_wait seconds or once it holds max_batch sentences, and
+        predict_fn is called once for all of them (duplicates sent once).
+    """
+
+    def __init__(self, predict_fn: Callable[[List[str]], list],
+                 max_wait: float = 0.005, max_batch: int = 256):
+        """
+        :param predict_fn: Maps a list of sentences to a list of embeddings
+        :param max_wait: Seconds to wait for more requests once a batch opens
+        :param max_batch: Maximum sentences per predict_fn call
+        """
+        self.predict_fn = predict_fn
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self.requests = Queue()
+
+        self.worker = Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, sentences: List[str]) -> Future:
+        """ :return: Future of the embeddings for sentences (in order) """
+        future = Future()
+        self.requests.put((list(sentences), future))
+        return future
+
+    def predict(self, sentences: List[str]) -> list:
+        return self.submit(sentences).result()
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            n_sentences = len(batch[0][0])
+            closes_at = monotonic() + self.max_wait
+            while n_sentences < self.max_batch:
+                remaining = closes_at - monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=remaining))
+                except Empty:
+                    break
+                n_sentences += len(batch[-1][0])
+            self.run_batch(batch)
+
+    def run_batch(self, batch: list):
+        # Send each distinct sentence once
+        positions = dict()
+        for sentences, _ in batch:
+            for sentence in sentences:
+                positions.setdefault(sentence, len(positions))
+
+        try:
+            embeddings = self.predict_fn(list(positions))
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        for sentences, future in batch:
+            future.set_result([embeddings[positions[s]] for s in sentences])
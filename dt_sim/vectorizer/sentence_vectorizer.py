@@ -1,15 +1,20 @@
 import os
 import os.path as p
 import json
+import base64
 import requests
+from requests.adapters import HTTPAdapter
 from time import time
 from pathlib import Path
 from typing import List, Union
 
+import numpy as np
 import tensorflow as tf
 import tensorflow_hub as hub
 
 from .base_vectorizer import BaseVectorizer
+from .embedding_cache import EmbeddingCache
+from .micro_batcher import MicroBatcher
 
 
 #### Query Vectorization ####
@@ -18,7 +23,28 @@ class DockerVectorizer(BaseVectorizer):
     Intended for fast Query Vectorization.
     Note: Ensure docker container is running before importing class.
     """
-    def __init__(self, large: bool = False, model_name: str = None):
+    request_formats = ('columnar', 'row', 'b64')
+
+    def __init__(self, large: bool = False, model_name: str = None,
+                 cache_size: int = 4096, cache_path: Union[str, Path] = None,
+                 pool_size: int = 32, batch_wait_ms: float = 0,
+                 max_batch: int = 256, request_format: str = 'columnar'):
+        """
+        :param large: Use the large USE (Transformer) model
+        :param model_name: TF Serving model name (overrides large)
+        :param cache_size: Number of query embeddings to cache (0: no cache)
+        :param cache_path: Optional .npz file that persists cached embeddings
+        :param pool_size: Keep-alive connections to TF Serving
+        :param batch_wait_ms: Combine queries from concurrent threads that
+            arrive within this window into one :predict call (0: off)
+        :param max_batch: Maximum sentences per micro-batch
+        :param request_format: TF Serving REST format
+            'columnar': {"inputs": {"text": [...]}}
+            'row':      {"instances": [{"text": ...}, ...]}
+            'b64':      row format with base64 encoded UTF-8 text
+        """
+        assert request_format in self.request_formats, \
+            f'request_format must be one of {self.request_formats}'
         super().__init__()
 
         if not model_name and large:
@@ -27,21 +53,93 @@ class DockerVectorizer(BaseVectorizer):
         elif not model_name:
             model_name = 'USE-lite-v2'
         self.url = f'http://localhost:8501/v1/models/{model_name}:predict'
+        self.request_format = request_format
 
-    def make_vectors(self, query: Union[str, List[str]]):
+        # Pooled keep-alive connections (shared by request threads)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.batcher = None
+        if batch_wait_ms:
+            self.batcher = MicroBatcher(self.post_predict,
+                                        max_wait=batch_wait_ms / 1000,
+                                        max_batch=max_batch)
+
+        self.cache = None
+        if cache_size:
+            self.cache = EmbeddingCache(limit=cache_size, path=cache_path)
+
+    def make_vectors(self, query: Union[str, List[str]]) -> np.array:
         """ Takes one query """
         if not isinstance(query, list):
             query = [str(query)]
         elif len(query) > 1:
             query = query[:1]
 
-        payload = {"inputs": {"text": query}}
-        payload = json.dumps(payload)
-
-        response = requests.post(self.url, data=payload)
+        return self.make_vector_batch(query)
+
+    def make_vector_batch(self, queries: List[str]) -> np.array:
+        """
+        Takes many queries (uncached ones are vectorized with a single request)
+        :return: Embeddings shaped (n_queries, dim)
+        """
+        queries = [str(query) for query in queries]
+        embeddings, missing = self.check_cache(queries)
+        if missing:
+            new_embeddings = self.predict([queries[i] for i in missing])
+            self.fill_cache(queries, embeddings, missing, new_embeddings)
+
+        return np.vstack(embeddings)
+
+    def check_cache(self, queries: List[str]):
+        """ :return: Cached embedding (or None) per query, indexes of misses """
+        if self.cache is None:
+            return [None] * len(queries), list(range(len(queries)))
+        embeddings = self.cache.get_many(queries)
+        missing = [i for i, emb in enumerate(embeddings) if emb is None]
+        return embeddings, missing
+
+    def fill_cache(self, queries: List[str], embeddings: list,
+                   missing: List[int], new_embeddings: list):
+        for i, emb in zip(missing, new_embeddings):
+            embeddings[i] = np.array(emb, dtype=np.float32)
+            if self.cache is not None:
+                self.cache.put(queries[i], embeddings[i])
+
+    def predict(self, sentences: List[str]):
+        if self.batcher is not None:
+            return self.batcher.predict(sentences)
+        return self.post_predict(sentences)
+
+    def post_predict(self, sentences: List[str]) -> list:
+        """ One :predict request to TF Serving (over a pooled connection) """
+        response = self.session.post(self.url, data=self.make_payload(sentences))
         response.raise_for_status()
 
-        return response.json()['outputs']
+        return self.parse_predictions(response.json())
+
+    def make_payload(self, sentences: List[str]) -> str:
+        if self.request_format == 'columnar':
+            payload = {"inputs": {"text": sentences}}
+        elif self.request_format == 'row':
+            payload = {"instances": [{"text": s} for s in sentences]}
+        else:
+            payload = {"instances": [
+                {"text": {"b64": base64.b64encode(s.encode('utf-8')).decode('ascii')}}
+                for s in sentences
+            ]}
+        return json.dumps(payload)
+
+    def parse_predictions(self, response_json: dict) -> list:
+        if self.request_format == 'columnar':
+            return response_json['outputs']
+
+        # Row format: one prediction per instance (a dict if multiple outputs)
+        predictions = response_json['predictions']
+        return [list(pred.values())[0] if isinstance(pred, dict) else pred
+                for pred in predictions]
 
 
 #### Corpus Vectorization ####
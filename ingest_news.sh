@@ -85,7 +85,7 @@ done
 ## Zip new indexes into deployed indexes
 # Switch to tmp service
 kill -15 $(ps -ef | grep "[s]imilarity_server" | awk '{print $2}'); sleep 1;
-python -u "${SERVICE}similarity_server.py" "$TMP_IDXS" -l -c 6 &
+python -u "${SERVICE}similarity_server.py" "$TMP_IDXS" -l -c 6 --lazy &
 
 # Zip-merge into main indexes
 # Note: echo "n" prevents deleting new indexes before second zip
@@ -95,7 +95,7 @@ echo "n" | python -u "${PREPROC}consolidate_shards.py" \
 # Switch back to main service
 LOG_FILE="/faiss/dig-text-similarity-search/logs/service/deploy_${MM}${DD}.out"
 kill -15 $(ps -ef | grep "[s]imilarity_server" | awk '{print $2}'); sleep 1;
-python -u "${SERVICE}similarity_server.py" "$MAIN_IDXS" -l -c 6 >> "$LOG_FILE" &
+python -u "${SERVICE}similarity_server.py" "$MAIN_IDXS" -l -c 6 --lazy >> "$LOG_FILE" &
 
 # Second zip-merge into tmp indexes
 # Note: echo "y" will delete new indexes
@@ -0,0 +1,58 @@
+# <editor-fold desc="Basic Imports">
+import os.path as p
+from time import time
+from argparse import ArgumentParser
+
+import sys
+sys.path.append(p.join(p.dirname(__file__), '..'))
+sys.path.append(p.join(p.dirname(__file__), '../..'))
+# </editor-fold>
+
+# <editor-fold desc="Parse Options">
+arp = ArgumentParser(description='Find the smallest nprobe that meets a recall target '
+                                 'for each shard size (powers of two). The table is '
+                                 'served with similarity_server.py --nprobe_table.')
+
+arp.add_argument('index_dir', help='Path to on-disk index shards.')
+arp.add_argument('query_vectors', help='Held-out query embeddings (.npy, n_queries x dim).')
+arp.add_argument('-o', '--output', default='nprobe_table.json',
+                 help='Where to write the table. (Default: nprobe_table.json)')
+arp.add_argument('-k', '--k', type=int, default=10,
+                 help='Nearest neighbors compared per query. (Default: 10)')
+arp.add_argument('--recall', type=float, default=0.95,
+                 help='Target recall@k against visiting every centroid. (Default: 0.95)')
+arp.add_argument('--shards_per_bucket', type=int, default=3,
+                 help='Shards sampled per size bucket. (Default: 3)')
+arp.add_argument('-c', '--centroids', type=int, default=4,
+                 help='nprobe for shards of sizes not calibrated. (Default: 4)')
+arp.add_argument('-r', '--recursive', action='store_true', default=False,
+                 help='Sample shards in sub directories of index_dir.')
+opts = arp.parse_args()
+# </editor-fold>
+
+import numpy as np
+
+from dt_sim.indexer.base_indexer import BaseIndexer
+from dt_sim.indexer.nprobe_tuner import NprobeTuner
+
+
+# Main
+def main():
+    t_0 = time()
+    index_paths = BaseIndexer.get_index_paths(opts.index_dir, recursive=opts.recursive)
+    query_vectors = np.load(opts.query_vectors)
+
+    # Newest shards first (most representative of what is searched)
+    tuner = NprobeTuner(default_nprobe=opts.centroids)
+    table = tuner.calibrate(index_paths[::-1], query_vectors, k=opts.k,
+                            recall_target=opts.recall,
+                            shards_per_bucket=opts.shards_per_bucket)
+    tuner.save(opts.output)
+
+    for bucket, nprobe in sorted(table.items()):
+        print(f' * {2 ** (bucket - 1):>12d}+ vectors: nprobe {nprobe}')
+    print(f'\nWrote {opts.output} in {time()-t_0:0.2f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+# <editor-fold desc="Basic Imports">
+import os
+import os.path as p
+from time import time
+from argparse import ArgumentParser
+
+import sys
+sys.path.append(p.join(p.dirname(__file__), '..'))
+sys.path.append(p.join(p.dirname(__file__), '../..'))
+# </editor-fold>
+
+# <editor-fold desc="Parse Options">
+arp = ArgumentParser(description='(Re)write the shard manifest of an index directory. '
+                                 'Shards made by consolidate_shards.py are recorded '
+                                 'automatically; use this for shards made before '
+                                 'manifests existed (reads every .index once).')
+
+arp.add_argument('index_dir', help='Path to on-disk index shards.')
+arp.add_argument('-r', '--recursive', action='store_true', default=False,
+                 help='Also write manifests for sub directories of index_dir.')
+opts = arp.parse_args()
+# </editor-fold>
+
+from dt_sim.indexer.shard_manifest import ShardManifest
+
+
+# Main
+def main():
+    index_dirs = [p.abspath(opts.index_dir)]
+    if opts.recursive:
+        index_dirs += [p.join(index_dirs[0], d) for d in sorted(os.listdir(index_dirs[0]))
+                       if p.isdir(p.join(index_dirs[0], d))]
+
+    for index_dir in index_dirs:
+        t_0 = time()
+        n_shards = ShardManifest(index_dir).rebuild()
+        print(f' * Recorded {n_shards} shards in {time()-t_0:0.2f}s: {index_dir}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+# <editor-fold desc="Basic Imports">
+import asyncio
+from aiohttp import web
+
+import os.path as p
+import json
+import traceback
+from functools import partial
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+
+import sys
+sys.path.append(p.join(p.dirname(__file__), '..'))
+sys.path.append(p.join(p.dirname(__file__), '../..'))
+
+from py_scripts.service.service_utils import add_index_args, load_range_shards, \
+    get_date_range, get_search_mode, get_nprobe, get_deadline, skipped_headers
+# </editor-fold>
+
+# <editor-fold desc="Parse Command Line Options">
+arp = ArgumentParser(description='Deploy multiple faiss index shards '
+                                 'as an asyncio RESTful API.')
+
+add_index_args(arp)
+arp.add_argument('-t', '--search_threads', type=int, default=32,
+                 help='Threads that wait on faiss shard searches. '
+                      'Requests beyond this wait on the event loop. (Default = 32)')
+opts = arp.parse_args()
+# </editor-fold>
+
+
+from dt_sim.processor.query_processor import QueryProcessor
+from dt_sim.vectorizer.async_vectorizer import AsyncDockerVectorizer
+
+from py_scripts.configs.config import std_config, lrg_config
+
+
+#### CONFIGURE ####
+if opts.large:
+    my_config = lrg_config
+else:
+    my_config = std_config
+
+# Change index paths if necessary
+if opts.index_dir_path:
+    my_config['faiss_index_path'] = p.abspath(opts.index_dir_path)
+
+
+#### INIT ####
+print(' * Initializing Query Vectorizer')   # Emb space Bool toggle
+query_vectorizer = AsyncDockerVectorizer(large=my_config['large_emb_space'],
+                                         cache_path=opts.embedding_cache,
+                                         request_format=opts.request_format)
+
+print(' * Initializing Faiss Indexes')
+faiss_indexer = load_range_shards(opts, my_config['faiss_index_path'],
+                                  query_log=query_vectorizer.cache.embeddings())
+faiss_executor = ThreadPoolExecutor(max_workers=opts.search_threads)
+
+print(' * Initializing Query Processor')
+qp = QueryProcessor(index_handler=faiss_indexer, query_vectorizer=query_vectorizer)
+
+
+def json_response(payload, status: int = 200, headers: dict = None) -> web.Response:
+    return web.Response(text=json.dumps(payload), status=status, headers=headers,
+                        content_type='application/json')
+
+
+def error_response(e: Exception) -> web.Response:
+    exc_type, exc_value, exc_traceback = sys.exc_info()
+    lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
+    print(''.join(lines))
+    return json_response({'message': str(e)}, 500)
+
+
+async def run_in_executor(func, *args, **kwargs):
+    """ Hands blocking faiss work to the search threads """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(faiss_executor, partial(func, *args, **kwargs))
+
+
+#### APP DEF ####
+async def hello(request: web.Request) -> web.Response:
+    return web.Response(text='DIG Text Similarity Search\n')
+
+
+async def text_similarity_search(request: web.Request) -> web.Response:
+    query = request.query.get('query', None)
+    k = int(request.query.get('k', 10))
+    if not query:
+        return json_response({'message': 'The service is not able to process null requests'}, 400)
+
+    try:
+        start_date, end_date = get_date_range(request.query)
+        mode = get_search_mode(request.query)
+        nprobe = get_nprobe(request.query)
+        deadline = get_deadline(request.query, opts.deadline_ms)
+    except ValueError as e:
+        return json_response({'message': str(e)}, 400)
+
+    # Specify payload format
+    rerank_by_doc = request.query.get('rerank_by_doc', 'false')
+    rerank_by_doc = str(rerank_by_doc).lower() == 'true'
+
+    try:
+        query_vector = await query_vectorizer.make_vectors_async(query)
+        results, skipped = await run_in_executor(qp.partial_search_vectors,
+                                                 query_vector, deadline,
+                                                 k=k, radius=opts.radius,
+                                                 start=start_date, end=end_date,
+                                                 rerank_by_doc=rerank_by_doc, mode=mode,
+                                                 nprobe=nprobe)
+    except Exception as e:
+        return error_response(e)
+
+    return json_response(results[0], headers=skipped_headers(skipped))
+
+
+async def batch_text_similarity_search(request: web.Request) -> web.Response:
+    """
+    JSON body: {"queries": [str, ...], "k": int, "start_date": str,
+                "end_date": str, "rerank_by_doc": bool, "mode": "range"|"knn",
+                "nprobe": int, "deadline_ms": float}
+    Returns one /search payload per query (in query order)
+    """
+    try:
+        params = await request.json()
+    except ValueError:
+        params = dict()
+    if not isinstance(params, dict):
+        params = dict()     # Not a JSON object: no queries
+    queries = params.get('queries', None)
+    k = int(params.get('k', 10))
+    if not queries or not isinstance(queries, list) \
+            or not all(isinstance(query, str) and query for query in queries):
+        return json_response({'message': 'Please provide a list of non-empty queries'}, 400)
+
+    try:
+        start_date, end_date = get_date_range(params)
+        mode = get_search_mode(params)
+        nprobe = get_nprobe(params)
+        deadline = get_deadline(params, opts.deadline_ms)
+    except ValueError as e:
+        return json_response({'message': str(e)}, 400)
+
+    # Specify payload format
+    rerank_by_doc = str(params.get('rerank_by_doc', 'false')).lower() == 'true'
+
+    try:
+        query_vectors = await query_vectorizer.make_vector_batch_async(queries)
+        results, skipped = await run_in_executor(qp.partial_search_vectors,
+                                                 query_vectors, deadline,
+                                                 k=k, radius=opts.radius,
+                                                 start=start_date, end=end_date,
+                                                 rerank_by_doc=rerank_by_doc, mode=mode,
+                                                 nprobe=nprobe)
+    except Exception as e:
+        return error_response(e)
+
+    return json_response(results, headers=skipped_headers(skipped))
+
+
+async def add_shard(request: web.Request) -> web.Response:
+    shard_path = p.abspath(request.query.get('path', ''))
+    if not p.exists(shard_path):
+        return json_response({'message': 'Path does not exist: {}'.format(shard_path)}, 404)
+
+    try:
+        await run_in_executor(qp.add_shard, shard_path)
+        return json_response({'message': 'Successfully added shard to faiss index'}, 201)
+    except Exception as e:
+        return error_response(e)
+
+
+async def remove_shard(request: web.Request) -> web.Response:
+    shard_path = p.abspath(request.query.get('path', ''))
+
+    try:
+        if not await run_in_executor(qp.remove_shard, shard_path):
+            return json_response({'message': 'Shard is not deployed: {}'.format(shard_path)}, 404)
+        return json_response({'message': 'Successfully removed shard from faiss index'})
+    except Exception as e:
+        return error_response(e)
+
+
+async def cache_stats(request: web.Request) -> web.Response:
+    return json_response(qp.cache_info())
+
+
+async def on_cleanup(app: web.Application):
+    await query_vectorizer.close()
+    faiss_executor.shutdown(wait=False)
+
+
+app = web.Application()
+app.router.add_get('/', hello)
+app.router.add_get('/search', text_similarity_search)
+app.router.add_post('/search/batch', batch_text_similarity_search)
+app.router.add_put('/faiss', add_shard)
+app.router.add_delete('/faiss', remove_shard)
+app.router.add_get('/cache', cache_stats)
+app.on_cleanup.append(on_cleanup)
+
+
+#### MAIN ####
+def main():
+    web.run_app(app, host=my_config['host'], port=int(my_config['port']))
+
+
+if __name__ == '__main__':
+    main()
@@ -13,12 +13,16 @@ arp.add_argument('-s', '--start_date', default='2019-03-01',
 arp.add_argument('-e', '--end_date', default=date.today().isoformat(),
                  help=f'Final ISO formatted publication date to search '
                       f'(Default: Today {date.today().isoformat()})')
+arp.add_argument('-m', '--mode', default='range', choices=['range', 'knn'],
+                 help='range: every hit within the radius; knn: nearest hits '
+                      'per shard within the radius (bounded work) (Default: range)')
 opts = arp.parse_args()
 
 
 local_url = 'http://localhost:5954/search'
 payload = {'query': opts.query,
            'start_date': opts.start_date,
-           'end_date': opts.end_date}
+           'end_date': opts.end_date,
+           'mode': opts.mode}
 r = requests.get(local_url, params=payload)
 print(r.text)
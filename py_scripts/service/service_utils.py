@@ -0,0 +1,333 @@
+import os
+import sys
+import fcntl
+import signal
+import socket
+from time import sleep
+from threading import Thread
+from datetime import date, timedelta
+from argparse import ArgumentParser, Namespace
+from typing import Callable
+
+__all__ = ['add_index_args', 'load_range_shards',
+           'get_date_range', 'get_search_mode', 'get_nprobe', 'get_deadline',
+           'skipped_headers', 'ShardRegistry', 'serve_forked']
+
+
+def add_index_args(arp: ArgumentParser):
+    """ Command line options shared by every similarity server """
+    arp.add_argument('index_dir_path', help='Path to index shards.')
+    arp.add_argument('-c', '--centroids', type=int, default=1,
+                     help='Number of centroids to visit during search. '
+                          'Speed vs. Accuracy trade-off. (Default = 1)')
+    arp.add_argument('-r', '--radius', type=float, default=0.65,
+                     help='Specify the maximum L2 distance from the query vector. '
+                          '(Default = 0.65, determined empirically)')
+    arp.add_argument('-l', '--large', action='store_true',
+                     help='Toggle large Universal Sentence Encoder (Transformer). '
+                          'Note: Encoder and Faiss embedding spaces must match!')
+    arp.add_argument('-a', '--also_load_nested', action='store_true', default=False,
+                     help='Load indexes nested in sub directories of index_dir_path. ')
+    arp.add_argument('--lazy', action='store_true', default=False,
+                     help='Open shards older than the maximum date-range (180 days) '
+                          'on the first query that needs them (faster restarts).')
+    arp.add_argument('--warmup_days', type=int, default=7,
+                     help='Read the inverted lists of shards from the most recent days '
+                          'into the page cache in the background. (Default = 7, 0: off)')
+    arp.add_argument('--warmup_gb', type=float, default=1,
+                     help='I/O budget of each warmup in GB. (Default = 1)')
+    arp.add_argument('--hot_gb', type=float, default=0,
+                     help='Memory budget in GB for shards held in RAM: the most recent '
+                          'shards first, then the most queried. Split evenly between '
+                          'pre-forked workers. (Default = 0, all on-disk)')
+    arp.add_argument('--hot_days', type=int, default=7,
+                     help='Shards from this many most recent days are held in RAM '
+                          'first (see --hot_gb). (Default = 7)')
+    arp.add_argument('--retention_days', type=int, default=0,
+                     help='Take shards older than this many days offline (checked hourly). '
+                          '(Default = 0, keep every shard)')
+    arp.add_argument('--load_workers', type=int, default=8,
+                     help='Number of shards read concurrently. (Default = 8)')
+    arp.add_argument('--nprobe_table', default=None,
+                     help='Per shard-size nprobe written by tune_nprobe.py. '
+                          '(Default: -c for every shard)')
+    arp.add_argument('--latency_slo_ms', type=float, default=None,
+                     help='Visit fewer centroids while the p90 latency of single-query '
+                          'searches exceeds this. (Default: off)')
+    arp.add_argument('--deadline_ms', type=float, default=None,
+                     help='Return the hits of the shards (newest first) that answered within '
+                          'this many ms, and list skipped dates in the X-Skipped-Date-Ranges '
+                          'header. Requests may set deadline_ms. (Default: wait for all shards)')
+    arp.add_argument('-e', '--embedding_cache', default=None,
+                     help='Path to a .npz file that persists cached query embeddings '
+                          'across restarts. (Default: in-memory only)')
+    arp.add_argument('--request_format', default='columnar',
+                     choices=['columnar', 'row', 'b64'],
+                     help='TF Serving REST request format. (Default = columnar)')
+
+
+def load_range_shards(opts: Namespace, index_dir_path: str, query_log=None,
+                      n_workers: int = 1):
+    """
+    Deploys the shards in index_dir_path as configured by add_index_args.
+    :param opts: Parsed command line options
+    :param query_log: Past query embeddings (see RangeShards)
+    :param n_workers: Serving processes that each load the shards
+        (they split the --hot_gb budget)
+    :return: RangeShards
+    """
+    from dt_sim.indexer.ivf_index_handlers import RangeShards
+    from dt_sim.indexer.nprobe_tuner import NprobeTuner
+
+    latency_slo = opts.latency_slo_ms / 1000 if opts.latency_slo_ms else None
+    if opts.nprobe_table:
+        nprobe_tuner = NprobeTuner.load(opts.nprobe_table, default_nprobe=opts.centroids,
+                                        latency_slo=latency_slo)
+    else:
+        nprobe_tuner = NprobeTuner(default_nprobe=opts.centroids, latency_slo=latency_slo)
+    return RangeShards(index_dir_path,
+                       nprobe=opts.centroids,
+                       get_nested=opts.also_load_nested,
+                       load_workers=opts.load_workers,
+                       lazy=opts.lazy,
+                       warmup_days=opts.warmup_days,
+                       warmup_bytes=int(opts.warmup_gb * 2**30),
+                       query_log=query_log,
+                       hot_bytes=int(opts.hot_gb * 2**30 / n_workers),
+                       hot_days=opts.hot_days,
+                       retention_days=opts.retention_days,
+                       nprobe_tuner=nprobe_tuner)
+
+
+def get_date_range(params: dict):
+    """
+    Default date-range search: past 45 days (max date-range: 180 day-span)
+    :param params: Request args or JSON body
+    :return: start_date, end_date as ISO date strings
+    """
+    end_date = params.get('end_date', date.isoformat(date.today()))
+    if end_date > date.isoformat(date.today()):     # Handles erroneous future dates
+        end_date = date.isoformat(date.today())
+    end_dt_obj = date(*tuple(int(ymd) for ymd in end_date.split('-')))
+    start_date = params.get('start_date', date.isoformat(end_dt_obj - timedelta(45)))
+    if not start_date <= end_date:
+        raise ValueError('Start-date must occur before end-date')
+
+    # Max date-range: 180 day-span
+    max_range = date.isoformat(end_dt_obj - timedelta(180))
+    if max_range > start_date:
+        start_date = max_range
+
+    return start_date, end_date
+
+
+def get_search_mode(params: dict, default: str = 'range') -> str:
+    """
+    'range': every hit within the radius (default)
+    'knn': k nearest hits per shard within the radius (bounded work per shard)
+    :param params: Request args or JSON body
+    """
+    mode = str(params.get('mode', default)).lower()
+    if mode not in ('range', 'knn'):
+        raise ValueError(f'Unknown search mode: {mode} (use range or knn)')
+    return mode
+
+
+def get_nprobe(params: dict):
+    """
+    Optional per-request number of centroids visited on every shard
+        (e.g. high for offline batch jobs, low for interactive users).
+        Values above the shards' number of centroids (nlist) visit every
+        centroid.
+    :param params: Request args or JSON body
+    :return: nprobe, or None to let the service choose
+    """
+    nprobe = params.get('nprobe', None)
+    if nprobe is None:
+        return None
+    try:
+        nprobe = int(nprobe)
+    except (TypeError, ValueError):
+        raise ValueError(f'nprobe must be an integer: {nprobe}')
+    if nprobe < 1:
+        raise ValueError(f'nprobe must be a positive integer: {nprobe}')
+    return nprobe
+
+
+def get_deadline(params: dict, default_ms: float = None):
+    """
+    Optional search deadline: shards that have not answered by then are
+        skipped (see skipped_headers)
+    :param params: Request args or JSON body ('deadline_ms')
+    :param default_ms: Service-wide deadline (None: wait for every shard)
+    :return: Deadline in seconds, or None
+    """
+    deadline_ms = params.get('deadline_ms', default_ms)
+    if deadline_ms is None:
+        return None
+    try:
+        deadline_ms = float(deadline_ms)
+    except (TypeError, ValueError):
+        raise ValueError(f'deadline_ms must be a number: {deadline_ms}')
+    if deadline_ms <= 0:
+        raise ValueError(f'deadline_ms must be positive: {deadline_ms}')
+    return deadline_ms / 1000
+
+
+def skipped_headers(skipped: list) -> dict:
+    """
+    Response headers that flag partial results.
+        X-Skipped-Date-Ranges: 2019-03-01/2019-03-03,2019-03-07/2019-03-07
+    :param skipped: (start, end) date ranges that were not searched
+    """
+    if not skipped:
+        return {'X-Partial-Results': 'false'}
+    return {'X-Partial-Results': 'true',
+            'X-Skipped-Date-Ranges': ','.join(f'{start}/{end}' for start, end in skipped)}
+
+
+class ShardRegistry(object):
+    """
+    Append-only log of shards added (PUT /faiss) or removed (DELETE /faiss).
+        Lets every pre-forked worker apply changes made through any one
+        of them. Workers (re)started later replay the whole log.
+        Lines: 'add\t/path/to/shard.index' or 'remove\t/path/to/shard.index'
+    """
+    actions = ('add', 'remove')
+
+    def __init__(self, path: str):
+        self.path = path
+        self.offset = 0
+
+    def publish(self, shard_path: str, action: str = 'add'):
+        assert action in self.actions, f'Unknown registry action: {action}'
+        with open(self.path, 'ab') as registry:
+            fcntl.flock(registry, fcntl.LOCK_EX)
+            registry.write(f'{action}\t{shard_path}\n'.encode('utf-8'))
+            registry.flush()
+            fcntl.flock(registry, fcntl.LOCK_UN)
+
+    def poll(self) -> list:
+        """ :return: (action, shard path) pairs published since the last poll """
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, 'rb') as registry:
+            fcntl.flock(registry, fcntl.LOCK_SH)
+            registry.seek(self.offset)
+            lines = registry.readlines()
+            fcntl.flock(registry, fcntl.LOCK_UN)
+
+        # Leave a partially written line for the next poll
+        if lines and not lines[-1].endswith(b'\n'):
+            lines = lines[:-1]
+        self.offset += sum(len(line) for line in lines)
+        return [tuple(line.decode('utf-8').rstrip('\n').split('\t', 1))
+                for line in lines if line.strip()]
+
+    def watch(self, apply: Callable[[str, str], None], interval: float = 1.0) -> Thread:
+        """ Calls apply(action, shard_path) for every published change (daemon thread) """
+        def run():
+            while True:
+                for action, shard_path in self.poll():
+                    try:
+                        apply(action, shard_path)
+                    except Exception as e:
+                        print(f'Could not {action} shard {shard_path}: {e}')
+                sleep(interval)
+
+        watcher = Thread(target=run, daemon=True)
+        watcher.start()
+        return watcher
+
+
+def serve_forked(app, host: str, port: int, n_workers: int,
+                 init_worker: Callable[[], None],
+                 close_worker: Callable[[], None] = None):
+    """
+    Pre-fork WSGI server: binds host:port once, then forks n_workers
+        processes that accept connections from the shared socket.
+        Workers that die are replaced. SIGINT/SIGTERM stop every worker.
+
+    Note: Nothing that starts threads or processes (i.e. RangeShards)
+        should be created before forking; init_worker runs in each worker.
+        Shards opened read-only in each worker share the page cache.
+
+    :param app: WSGI application
+    :param init_worker: Called once in each worker before it serves
+    :param close_worker: Called once in each worker before it exits
+        (workers leave through os._exit, so atexit hooks do not run)
+    """
+    from werkzeug.serving import make_server
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(socket.SOMAXCONN)
+    sock.set_inheritable(True)
+
+    def spawn_worker() -> int:
+        pid = os.fork()
+        if pid:
+            return pid
+
+        # Worker
+        def exit_worker(signum, frame):
+            raise SystemExit(0)
+
+        signal.signal(signal.SIGINT, exit_worker)
+        signal.signal(signal.SIGTERM, exit_worker)
+        exit_code = 0
+        try:
+            init_worker()
+            server = make_server(host, port, app, threaded=True, fd=sock.fileno())
+            print(f' * Worker {os.getpid()} serving on http://{host}:{port}/')
+            server.serve_forever()
+        except SystemExit:
+            pass
+        except Exception as e:
+            print(f'Worker {os.getpid()} failed: {e}')
+            exit_code = 1
+        finally:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            if close_worker is not None:
+                try:
+                    close_worker()
+                except Exception as e:
+                    print(f'Worker {os.getpid()} failed to close: {e}')
+            sys.stdout.flush()
+            os._exit(exit_code)
+
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for worker_pid in workers:
+            try:
+                os.kill(worker_pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    workers = set(spawn_worker() for _ in range(n_workers))
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        if pid not in workers:
+            continue
+        workers.discard(pid)
+        if stopping:
+            continue
+        if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 1:
+            print(f'Worker {pid} failed to start, not restarting it')
+            continue
+        print(f'Worker {pid} exited, restarting it')
+        workers.add(spawn_worker())
+
+    sock.close()
@@ -4,41 +4,41 @@ from flask import Flask, jsonify
 from flask import request
 from flask_cors import CORS
 
+import os
 import os.path as p
 import json
+import tempfile
 import traceback
-from datetime import date, timedelta
 from argparse import ArgumentParser
 
 import sys
 sys.path.append(p.join(p.dirname(__file__), '..'))
 sys.path.append(p.join(p.dirname(__file__), '../..'))
+
+from py_scripts.service.service_utils import add_index_args, load_range_shards, \
+    get_date_range, get_search_mode, get_nprobe, get_deadline, skipped_headers, \
+    ShardRegistry, serve_forked
 # </editor-fold>
 
 # <editor-fold desc="Parse Command Line Options">
 arp = ArgumentParser(description='Deploy multiple faiss index shards '
                                  'as a RESTful API.')
 
-arp.add_argument('index_dir_path', help='Path to index shards.')
-arp.add_argument('-c', '--centroids', type=int, default=1,
-                 help='Number of centroids to visit during search. '
-                      'Speed vs. Accuracy trade-off. (Default = 1)')
-arp.add_argument('-r', '--radius', type=float, default=0.65,
-                 help='Specify the maximum L2 distance from the query vector. '
-                      '(Default = 0.65, determined empirically)')
-arp.add_argument('-l', '--large', action='store_true',
-                 help='Toggle large Universal Sentence Encoder (Transformer). '
-                      'Note: Encoder and Faiss embedding spaces must match!')
-arp.add_argument('-a', '--also_load_nested', action='store_true', default=False,
-                 help='Load indexes nested in sub directories of index_dir_path. ')
+add_index_args(arp)
 arp.add_argument('-d', '--debug', action='store_true', default=False,
                  help='Increases verbosity of Flask app.')
+arp.add_argument('-b', '--batch_wait_ms', type=float, default=0,
+                 help='Combine concurrent queries that arrive within this many '
+                      'milliseconds into one TF Serving request. (Default = 0, off)')
+arp.add_argument('-w', '--workers', type=int, default=1,
+                 help='Serve from this many pre-forked processes behind one port. '
+                      'Shards are memory-mapped and shared through the page cache. '
+                      '(Default = 1, single process)')
 opts = arp.parse_args()
 # </editor-fold>
 
 
 from dt_sim.processor.query_processor import QueryProcessor
-from dt_sim.indexer.ivf_index_handlers import RangeShards
 from dt_sim.vectorizer.sentence_vectorizer import DockerVectorizer
 
 from py_scripts.configs.config import std_config, lrg_config
@@ -59,16 +59,39 @@ if opts.index_dir_path:
 app = Flask(__name__)
 CORS(app, supports_credentials=True)
 
-print(' * Initializing Faiss Indexes')
-faiss_indexer = RangeShards(my_config['faiss_index_path'],
-                            nprobe=opts.centroids,
-                            get_nested=opts.also_load_nested)
+qp = None               # type: QueryProcessor
+shard_registry = None   # type: ShardRegistry
+
+
+def init_query_processor():
+    """ Runs once per serving process (after forking, if pre-forked) """
+    global qp
+
+    print(' * Initializing Query Vectorizer')   # Emb space Bool toggle
+    query_vectorizer = DockerVectorizer(large=my_config['large_emb_space'],
+                                        cache_path=opts.embedding_cache,
+                                        batch_wait_ms=opts.batch_wait_ms,
+                                        request_format=opts.request_format)
+
+    print(' * Initializing Faiss Indexes')
+    faiss_indexer = load_range_shards(opts, my_config['faiss_index_path'],
+                                      query_log=query_vectorizer.cache.embeddings(),
+                                      n_workers=opts.workers)
 
-print(' * Initializing Query Vectorizer')   # Emb space Bool toggle
-query_vectorizer = DockerVectorizer(large=my_config['large_emb_space'])
+    print(' * Initializing Query Processor')
+    qp = QueryProcessor(index_handler=faiss_indexer, query_vectorizer=query_vectorizer)
 
-print(' * Initializing Query Processor')
-qp = QueryProcessor(index_handler=faiss_indexer, query_vectorizer=query_vectorizer)
+    if shard_registry is not None:
+        shard_registry.watch(apply_registered_change)
+
+
+def apply_registered_change(action: str, shard_path: str):
+    """ Adds/removes a shard changed through /faiss on another worker """
+    deployed = shard_path in {str(path) for path in qp.indexer.paths_to_shards}
+    if action == 'add' and not deployed:
+        qp.add_shard(shard_path)
+    elif action == 'remove' and deployed:
+        qp.remove_shard(shard_path)
 
 
 #### APP DEF ####
@@ -84,35 +107,90 @@ def text_similarity_search():
     if not query:
         return jsonify({'message': 'The service is not able to process null requests'}), 400
 
-    # Default date-range search: past 45 days
-    end_date = request.args.get('end_date', date.isoformat(date.today()))
-    if end_date > date.isoformat(date.today()):     # Handles erroneous future dates
-        end_date = date.isoformat(date.today())
-    end_dt_obj = date(*tuple(int(ymd) for ymd in end_date.split('-')))
-    start_date = request.args.get('start_date', date.isoformat(end_dt_obj - timedelta(45)))
-    if not start_date <= end_date:
-        return jsonify({'message': 'Start-date must occur before end-date'}), 400
-
-    # Max date-range: 180 day-span
-    max_range = date.isoformat(end_dt_obj - timedelta(180))
-    if max_range > start_date:
-        start_date = max_range
+    try:
+        start_date, end_date = get_date_range(request.args)
+        mode = get_search_mode(request.args)
+        nprobe = get_nprobe(request.args)
+        deadline = get_deadline(request.args, opts.deadline_ms)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
 
     # Specify payload format
     rerank_by_doc = request.args.get('rerank_by_doc', 'false')
     rerank_by_doc = str(rerank_by_doc).lower() == 'true'
 
     try:
-        results = qp.query_corpus(query, k=k, radius=opts.radius,
-                                  start=start_date, end=end_date,
-                                  rerank_by_doc=rerank_by_doc)
+        skipped = list()
+        if deadline is None:
+            results = qp.query_corpus(query, k=k, radius=opts.radius,
+                                      start=start_date, end=end_date,
+                                      rerank_by_doc=rerank_by_doc, mode=mode,
+                                      nprobe=nprobe)
+        else:
+            # Partial results are not cached
+            results, skipped = qp.partial_search_vectors(qp.vectorize(query), deadline,
+                                                         k=k, radius=opts.radius,
+                                                         start=start_date, end=end_date,
+                                                         rerank_by_doc=rerank_by_doc,
+                                                         mode=mode, nprobe=nprobe)
+            results = results[0]
+    except Exception as e:
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+        lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
+        print(''.join(lines))
+        return jsonify({'message': str(e)}), 500
+
+    return json.dumps(results), 200, skipped_headers(skipped)
+
+
+@app.route('/search/batch', methods=['POST'])
+def batch_text_similarity_search():
+    """
+    JSON body: {"queries": [str, ...], "k": int, "start_date": str,
+                "end_date": str, "rerank_by_doc": bool, "mode": "range"|"knn",
+                "nprobe": int, "deadline_ms": float}
+    Returns one /search payload per query (in query order)
+    """
+    params = request.get_json(silent=True)
+    if not isinstance(params, dict):
+        params = dict()     # Not a JSON object: no queries
+    queries = params.get('queries', None)
+    k = int(params.get('k', 10))
+    if not queries or not isinstance(queries, list) \
+            or not all(isinstance(query, str) and query for query in queries):
+        return jsonify({'message': 'Please provide a list of non-empty queries'}), 400
+
+    try:
+        start_date, end_date = get_date_range(params)
+        mode = get_search_mode(params)
+        nprobe = get_nprobe(params)
+        deadline = get_deadline(params, opts.deadline_ms)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+
+    # Specify payload format
+    rerank_by_doc = str(params.get('rerank_by_doc', 'false')).lower() == 'true'
+
+    try:
+        skipped = list()
+        if deadline is None:
+            results = qp.batch_query_corpus(queries, k=k, radius=opts.radius,
+                                            start=start_date, end=end_date,
+                                            rerank_by_doc=rerank_by_doc, mode=mode,
+                                            nprobe=nprobe)
+        else:
+            results, skipped = qp.partial_search_vectors(qp.vectorize_batch(queries), deadline,
+                                                         k=k, radius=opts.radius,
+                                                         start=start_date, end=end_date,
+                                                         rerank_by_doc=rerank_by_doc,
+                                                         mode=mode, nprobe=nprobe)
     except Exception as e:
         exc_type, exc_value, exc_traceback = sys.exc_info()
         lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
         print(''.join(lines))
         return jsonify({'message': str(e)}), 500
 
-    return json.dumps(results), 200
+    return json.dumps(results), 200, skipped_headers(skipped)
 
 
 @app.route('/faiss', methods=['PUT'])
@@ -123,6 +201,8 @@ def add_shard():
 
     try:
         qp.add_shard(shard_path)
+        if shard_registry is not None:
+            shard_registry.publish(shard_path)
         return jsonify({'message': 'Successfully added shard to faiss index'}), 201
     except Exception as e:
         exc_type, exc_value, exc_traceback = sys.exc_info()
@@ -131,12 +211,53 @@ def add_shard():
         return jsonify({'message': str(e)}), 500
 
 
+@app.route('/faiss', methods=['DELETE'])
+def remove_shard():
+    shard_path = p.abspath(request.args.get('path', ''))
+
+    try:
+        if not qp.remove_shard(shard_path):
+            return jsonify({'message': 'Shard is not deployed: {}'.format(shard_path)}), 404
+        if shard_registry is not None:
+            shard_registry.publish(shard_path, action='remove')
+        return jsonify({'message': 'Successfully removed shard from faiss index'}), 200
+    except Exception as e:
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+        lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
+        print(''.join(lines))
+        return jsonify({'message': str(e)}), 500
+
+
+@app.route('/cache', methods=['GET'])
+def cache_stats():
+    return jsonify(qp.cache_info()), 200
+
+
+def close_query_processor():
+    """ Stops the serving process's shard workers """
+    if qp is not None and hasattr(qp.indexer, 'close'):
+        qp.indexer.close()
+
+
 #### MAIN ####
 def main():
-    app.run(host=my_config['host'], port=my_config['port'],
-            threaded=True, debug=opts.debug)
+    global shard_registry
+
+    if opts.workers > 1:
+        registry_fd, registry_path = tempfile.mkstemp(prefix='deployed_shards_')
+        os.close(registry_fd)
+        shard_registry = ShardRegistry(registry_path)
+        try:
+            serve_forked(app, my_config['host'], int(my_config['port']),
+                         n_workers=opts.workers, init_worker=init_query_processor,
+                         close_worker=close_query_processor)
+        finally:
+            os.remove(registry_path)
+    else:
+        init_query_processor()
+        app.run(host=my_config['host'], port=my_config['port'],
+                threaded=True, debug=opts.debug)
 
 
 if __name__ == '__main__':
-    # TODO: Cache ifps on startup
     main()